@@ -1,7 +1,24 @@
 # Used to format crop insurance data into a dynamically created spreadsheet
 
-import xlsxwriter
-import psycopg2
+# xlsxwriter and psycopg2 are imported inside the code that needs them so that
+# subcommands which never touch the database (or never render) start quickly
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+# Default connection string for the insurance database
+DEFAULT_DSN = "dbname=DB2 user=brandonsturgeon password=brandon1 host=localhost"
+
+# Heavy third party modules each subcommand needs, loaded by import_for()
+COMMAND_IMPORTS = {"generate": ["psycopg2", "xlsxwriter"],
+                   "render": ["xlsxwriter"],
+                   "batch": ["psycopg2", "xlsxwriter"],
+                   "indexes": ["psycopg2"],
+                   "results": ["psycopg2"],
+                   "bench": []}
 
 
 # Converts Row,Col notation to LetterNum notation
@@ -16,37 +33,142 @@ def rc_to_ln_range(r, c, r1, c1):
     return letters[c]+str(r+1)+":"+letters[c1]+str(r1+1)
 
 
+# Cell formats, registered on every workbook in this order
+# Format objects belong to their workbook, so they can't be shared between reports. The direct writer
+# precomputes its xf indices from this order, while xlsxwriter numbers formats as they're first used
+STYLES = [("unlocked", {"locked": 0}),
+          ("bold", {"bold": True}),
+          ("underline", {"underline": True}),
+
+          # Bolded, Bordered, Grey, Centered horizontally and vertically
+          ("format_01", {"bold": True,
+                         "border": 1,
+                         "fg_color": "#555555",
+                         "align": "center",
+                         "valign": "vcenter",
+                         "text_wrap": 1}),
+          # Bolded, Bordered, Centered H+Z
+          ("format_02", {"bold": True,
+                         "border": 1,
+                         "align": "center",
+                         "valign": "vcenter"}),
+          # Bolded, Top Border
+          ("format_03", {"bold": True,
+                         "top": 1,
+                         "hidden": 1})]
+
+
+# The static skeleton of one sheet type, built once at import and stamped onto every report
+# Ops are (worksheet method, args, style name or None)
+# setup ops run once per sheet, unit ops and totals ops run per unit with their first arg offset by the current row
+class SheetTemplate():
+    def __init__(self, gen_h=(), h_order=(), field_unlock=(), setup=(), unit=(), totals=()):
+        self.gen_h = list(gen_h)
+        self.h_order = list(h_order)
+        self.field_unlock = list(field_unlock)
+        self.setup = list(setup)
+        self.unit = list(unit)
+        self.totals = list(totals)
+
+
+# "=SUM(..)" formulas over n cells down a column, keyed by (first row, column, n)
+# Unit blocks land on the same rows in reports with the same layout, so batches reuse these instead of rebuilding them
+SUM_FORMULAS = {}
+SUM_FORMULAS_LIMIT = 4096
+
+
+def sum_formula(row, col, n):
+    key = (row, col, n)
+    formula = SUM_FORMULAS.get(key)
+    if formula is None:
+        formula = "=SUM(" + ",".join(rc_to_ln(r, col) for r in xrange(row, row + n)) + ")"
+        if len(SUM_FORMULAS) < SUM_FORMULAS_LIMIT:
+            SUM_FORMULAS[key] = formula
+    return formula
+
+
+# Headers for the zones section, shared by every unit sheet
+ZONE_HEADERS = ["Field-Zone", "Acres", "Actual Production", "Actual Yield"]
+
+
+# Headers for the general info at the top of the enterprise sheet
+ENTERPRISE_GEN_HEADERS = ["Total Acres", "Total Bushel Guarantee", "Total Actual Bushels", "MPCI Bu Loss", "MPCI Loss"]
+
+
+# Builds the template for the optional/HPP style unit sheets, which only differ in title, widths and general info
+def make_unit_template(title, widths, gen_h):
+    setup = [("protect", (), None),
+             ("merge_range", ("A1:F1", title), "format_01")]
+    setup += [("set_column", (c, 0, w), None) for c, w in widths]
+
+    # Headers for the general info, split over two rows, then the headers for our zone columns
+    unit = [("write_row", (1, 1, gen_h[:4]), "format_01"),
+            ("write_row", (4, 1, gen_h[4:]), "format_01"),
+            ("write_row", (8, 1, ZONE_HEADERS), "format_01")]
+
+    totals = [("write", (0, 1, "Totals: "), "format_03")]
+
+    return SheetTemplate(gen_h, ZONE_HEADERS, ["Acres"], setup, unit, totals)
+
+
+TEMPLATES = {
+    "policy_info": SheetTemplate(
+        # This is the order we want the data to be displayed in, we remove values if they're not in data.keys()
+        # When this policy doesn't have HPP info, for example, the HPP Coverage and HPP Practice are removed
+        h_order=["County", "Units", "MPCI Coverage", "Practice", "HPP Coverage",
+                 "HPP Practice", "Harvest Price", "Spring Price", "Percent of Spring Price"],
+        # Total width should be 175, we merge them later so each needs to be ~half
+        setup=[("protect", (), None),
+               ("set_row", (0, 25), None),
+               ("set_column", (0, 1, 25), None),
+               ("merge_range", ("A1:B1", "Insurance Policy Info"), "format_01")]),
+
+    "enterprise_units": SheetTemplate(
+        gen_h=ENTERPRISE_GEN_HEADERS,
+        h_order=ZONE_HEADERS,
+        field_unlock=["Acres"],
+        setup=[("protect", (), None),
+               ("merge_range", ("A1:G1", "Enterprise Units"), "format_01"),
+               ("write_row", (2, 1, ENTERPRISE_GEN_HEADERS), None),
+               ("set_column", (2, 0, 15), None),
+               ("set_column", (3, 0, 15), None),
+               ("set_column", (4, 0, 15), None)],
+        unit=[("write_row", (4, 1, ZONE_HEADERS), "format_01")],
+        totals=[("write", (0, 1, "Totals: "), "format_03")]),
+
+    "optional_units": make_unit_template(
+        "Optional Units",
+        [(1, 20), (2, 40), (3, 20), (4, 15), (5, 5), (7, 15), (8, 15), (9, 15)],
+        ["Total Acres", "APH", "Yield Guarantee", "guarantee/acre",
+         "Total Bushel Guarantee", "MPCI Bushel Loss per acre", "MPCI Loss"]),
+
+    "hpp_units": make_unit_template(
+        "HPP Units",
+        [(1, 20), (2, 12), (3, 15), (4, 20), (5, 15), (7, 15), (8, 15), (9, 15)],
+        ["Total Acres", "Modified APH", "MPCI Yield Guarantee", "Covered Bushels", "guarantee/acre",
+         "Loss Percent", "Potential Bushel Loss", "Potential Dollar Loss", "Actual Dollar Loss"])
+}
+
+
 # Main creation class
+# backend is "xlsxwriter", or "direct" for the DirectWorkbook writer
 class Create():
-    def __init__(self, name, data, verbose):
+    def __init__(self, name, data, verbose, backend="xlsxwriter"):
         self.name = name
         self.data = data
         self.verbose = verbose
 
         # Creates the actual file
-        self.workbook = xlsxwriter.Workbook(self.name+".xlsx")
+        if backend == "direct":
+            self.workbook = DirectWorkbook(self.name+".xlsx")
+        else:
+            import xlsxwriter
+            self.workbook = xlsxwriter.Workbook(self.name+".xlsx")
 
         # Formats #
-        self.unlocked = self.workbook.add_format({"locked": 0})
-        self.bold = self.workbook.add_format({"bold": True})
-        self.underline = self.workbook.add_format({"underline": True})
-
-        # Bolded, Bordered, Grey, Centered horizontally and vertically
-        self.format_01 = self.workbook.add_format({"bold": True,
-                                                   "border": 1,
-                                                   "fg_color": "#555555",
-                                                   "align": "center",
-                                                   "valign": "vcenter",
-                                                   "text_wrap": 1})
-        # Bolded, Bordered, Centered H+Z
-        self.format_02 = self.workbook.add_format({"bold": True,
-                                                   "border": 1,
-                                                   "align": "center",
-                                                   "valign": "vcenter"})
-        # Bolded, Top Border
-        self.format_03 = self.workbook.add_format({"bold": True,
-                                                   "top": 1,
-                                                   "hidden": 1})
+        self.styles = {}
+        for style, properties in STYLES:
+            self.styles[style] = self.workbook.add_format(properties)
 
         self.main()
 
@@ -65,27 +187,24 @@ class Create():
 
         self.workbook.close()
 
+    # Runs a template's ops against a page, offsetting the row of each op by r
+    def stamp(self, page, ops, r=0):
+        for method, args, style in ops:
+            if r:
+                args = (args[0] + r,) + args[1:]
+            if style is not None:
+                args = args + (self.styles[style],)
+            getattr(page, method)(*args)
+
     # Creates and formats the Policy Information sheet
     def make_policy_info(self, data):
         self.v_print("Creating policy_info sheet..")
+        template = TEMPLATES["policy_info"]
 
         page = self.workbook.add_worksheet()
-        page.protect()
-
-        # Row/Column sizes
-        page.set_row(0, 25)
+        self.stamp(page, template.setup)
 
-        # Total width should be 175, we merge them later so each needs to be ~half
-        page.set_column(0, 1, 25)
-
-        # Header
-        page.merge_range("A1:B1", "Insurance Policy Info", self.format_01)
-
-        # This is the order we want the data to be displayed in, we remove values if they're not in data.keys()
-        # When this policy doesn't ahve HPP info, for example, the HPP Coverage and HPP Practice are removed
-        h_order = ["County", "Units", "MPCI Coverage", "Practice", "HPP Coverage",
-                   "HPP Practice", "Harvest Price", "Spring Price", "Percent of Spring Price"]
-        h_order = [x for x in h_order if x in data.keys()]
+        h_order = [x for x in template.h_order if x in data.keys()]
 
         # Walks through h_order and gets the value or k from data to form a list, which is then written
         for r, k in enumerate(h_order):
@@ -94,32 +213,23 @@ class Create():
     # Creates and formats the Enterprise Unit sheet
     def make_enterprise_units(self, data):
         self.v_print("Creating enterprise_units sheet..")
+        template = TEMPLATES["enterprise_units"]
+        unlocked = self.styles["unlocked"]
+        format_01 = self.styles["format_01"]
 
         page = self.workbook.add_worksheet()
-        page.protect()
-
-        # Header
-        page.merge_range("A1:G1", "Enterprise Units", self.format_01)
-        page.merge_range("A3:B3", self.data["policy_info"]["County"], self.format_02)
-
-        # Sheet info
-        h = ["Total Acres", "Total Bushel Guarantee", "Total Actual Bushels", "MPCI Bu Loss", "MPCI Loss"]
-        page.write_row(2, 1, h)
+        self.stamp(page, template.setup)
+        page.merge_range("A3:B3", self.data["policy_info"]["County"], self.styles["format_02"])
 
         # Sheet data
         acre_totals = []
 
-        # Setting Column Width
-        page.set_column(2, 0, 15)
-        page.set_column(3, 0, 15)
-        page.set_column(4, 0, 15)
-
         # General info
-        page.write_row(3, 1, data["gen"].keys(), self.format_01)
+        page.write_row(3, 1, data["gen"].keys(), format_01)
         page.write_row(4, 1, data["gen"].values())
 
         # Totals dictionary
-        h_order = ["Field-Zone", "Acres", "Actual Production", "Actual Yield"]
+        h_order = template.h_order
         totals = dict(zip(h_order, [[] for _ in xrange(len(h_order))]))
 
         # Row counter
@@ -128,21 +238,20 @@ class Create():
         for name in units:
             unit = data["units"][name]
 
-            page.write(r, 1, name, self.format_01)
+            page.write(r, 1, name, format_01)
             # The general information for this unit
-            page.write_row(r+1, 2, unit["gen"].keys(), self.format_01)
+            page.write_row(r+1, 2, unit["gen"].keys(), format_01)
             page.write_row(r+2, 2, unit["gen"].values())
 
-            # Sets our headers for the zone data
             # Sets the headers for our zone columns
-            page.write_row(r+4, 1, h_order, self.format_01)
+            self.stamp(page, template.unit, r)
 
             r += 5
             # Creates the table by just writing each zone's ordered values as a list
             for zone in unit["zones"]:
                 for i, h in enumerate(h_order):
-                    if h in field_unlock:
-                        page.write(r, i+1, zone[h], self.unlocked)
+                    if h in template.field_unlock:
+                        page.write(r, i+1, zone[h], unlocked)
                     else:
                         page.write(r, i+1, zone[h])
                     cell = rc_to_ln(r, i+1)
@@ -155,10 +264,10 @@ class Create():
             totals.pop("Field-Zone", None)
 
             # Totals writing
-            page.write(r, 1, "Totals: ", self.format_03)
+            self.stamp(page, template.totals, r)
             for i, c in enumerate(range(4, 6)):
                 _formula = totals[h_order[i+1]]
-                page.write_formula(r, c, _formula, self.format_01)
+                page.write_formula(r, c, _formula, format_01)
 
                 # For the sheet totals
                 if i == 0:
@@ -168,28 +277,26 @@ class Create():
     # Formats the Optional Units sheet
     def make_optional_units(self, data):
         self.v_print("Creating optional_units sheet..")
+        self.make_units(TEMPLATES["optional_units"], data)
 
-        page = self.workbook.add_worksheet()
-        page.protect()
-
-        # Header
-        page.merge_range("A1:F1", "Optional Units", self.format_01)
+    # Formats the HPP Units sheet
+    def make_hpp_units(self, data):
+        self.v_print("Creating hpp_units sheet..")
+        self.make_units(TEMPLATES["hpp_units"], data)
 
-        page.set_column(1, 0, 20)
-        page.set_column(2, 0, 40)
-        page.set_column(3, 0, 20)
-        page.set_column(4, 0, 15)
-        page.set_column(5, 0, 5)
-        page.set_column(7, 0, 15)
-        page.set_column(8, 0, 15)
-        page.set_column(9, 0, 15)
+    # Stamps a unit sheet template and fills in each unit's general info, zones and totals
+    def make_units(self, template, data):
+        unlocked = self.styles["unlocked"]
+        format_01 = self.styles["format_01"]
+        format_03 = self.styles["format_03"]
+        gen_h = template.gen_h
+        h_order = template.h_order
 
-        # Headers for the general info
-        gen_h = ["Total Acres", "APH", "Yield Guarantee", "guarantee/acre",
-                 "Total Bushel Guarantee", "MPCI Bushel Loss per acre", "MPCI Loss"]
+        # Format of each zone column, fields in field_unlock are unlocked
+        zone_styles = [unlocked if h in template.field_unlock else None for h in h_order]
 
-        # Headers for the zones section
-        h_order = ["Field-Zone", "Acres", "Actual Production", "Actual Yield"]
+        page = self.workbook.add_worksheet()
+        self.stamp(page, template.setup)
 
         # Row counter
         r = 2
@@ -197,175 +304,786 @@ class Create():
         for name in units:
             unit = data["units"][name]
 
-            page.write(r, 0, name, self.format_01)
+            page.write(r, 0, name, format_01)
+
+            # Static headers for the general info and zone columns
+            self.stamp(page, template.unit, r)
 
             # General unit information
             values = [unit["gen"][x] for x in gen_h]
-
-            page.write_row(r+1, 1, gen_h[:4], self.format_01)
             page.write_row(r+2, 1, values[:4])
             acres_row = r+2
-
-            page.write_row(r+4, 1, gen_h[4:], self.format_01)
             page.write_row(r+5, 1, values[4:])
 
-            # Sets the headers for our zone columns
-            page.write_row(r+8, 1, h_order, self.format_01)
-
-            # Which fields are unlocked
-            field_unlock = ["Acres"]
-
-            # Total dictionary
-            totals = dict(zip(h_order, [[] for _ in xrange(len(h_order))]))
-
             r += 9
+            first_zone_row = r
             # Writes each value for the zone, unlocks fields that are in field_unlock
             for zone in unit["zones"]:
                 for i, h in enumerate(h_order):
-                    if h in field_unlock:
-                        page.write(r, i+1, zone[h], self.unlocked)
-                    else:
-                        page.write(r, i+1, zone[h])
-                    cell = rc_to_ln(r, i+1)
-                    totals[h].append(cell)
+                    page.write(r, i+1, zone[h], zone_styles[i])
                 r += 1
 
-            # Creates the SUM formulas for each unit
-            for h in h_order:
-                _sum = "=SUM("+",".join(totals[h])+")"
-                totals[h] = _sum
-            totals.pop("Field-Zone", None)
-
-            # Totals writing
-            page.write(r, 1, "Totals: ", self.format_03)
-            for i, c in enumerate(range(2, 5)):
-                _formula = totals[h_order[i+1]]
-                page.write_formula(r, c, _formula, self.format_03)
+            # Totals writing, the SUM formulas cover every zone row of the unit
+            n = len(unit["zones"])
+            self.stamp(page, template.totals, r)
+            for c in range(2, 5):
+                page.write_formula(r, c, sum_formula(first_zone_row, c, n), format_03)
 
             # Writes the total acres formula to the general info, too
-            page.write_formula(acres_row, 1, totals["Acres"], self.format_03)
+            page.write_formula(acres_row, 1, sum_formula(first_zone_row, h_order.index("Acres") + 1, n), format_03)
             r += 3
 
-    # Formats the HPP Units sheet
-    def make_hpp_units(self, data):
-        self.v_print("Creating hpp_units sheet..")
+    # Used for printing status messages if self.verbose is enabled
+    def v_print(self, message):
+        if self.verbose:
+            print message
 
-        page = self.workbook.add_worksheet()
-        page.protect()
 
-        # Header
-        page.merge_range("A1:F1", "HPP Units", self.format_01)
+# Converts a 0 based column number to its letters, past Z as well (AA, AB, ..)
+def col_letters(c):
+    letters = ""
+    c += 1
+    while c:
+        c, rem = divmod(c - 1, 26)
+        letters = chr(65 + rem) + letters
+    return letters
+
+
+# Converts LetterNum notation (A1, AB12) to (row, col)
+def ln_to_rc(cell):
+    split = len(cell.rstrip("0123456789"))
+    col = 0
+    for letter in cell[:split]:
+        col = col * 26 + ord(letter.upper()) - 64
+    return int(cell[split:]) - 1, col - 1
+
+
+# Escapes text for use inside an XML element
+def xml_escape(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+XML_HEADER = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+MAIN_NS = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+REL_NS = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+
+# Cell fragments of header rows (all text, the same in every report), shared by every DirectWorkbook
+# Keyed by (column, values, style index), each fragment is a cell's XML after its reference
+FRAGMENTS = {}
+FRAGMENTS_LIMIT = 2048
+
+
+# The xf for one format in STYLES, as (font, fill, border, alignment, protection) XML pieces
+def style_parts(properties):
+    font, fill, border, alignment, protection = "", "", "", [], []
+    # Sorted so that <b/> comes before <u/>, Excel cares about element order inside <font>
+    for k, v in sorted(properties.items()):
+        if k == "bold":
+            font += "<b/>" if v else ""
+        elif k == "underline":
+            font += "<u/>" if v else ""
+        elif k == "fg_color":
+            fill = '<patternFill patternType="solid"><fgColor rgb="FF' + v.lstrip("#").upper() + '"/>' \
+                   '<bgColor indexed="64"/></patternFill>'
+        elif k == "border":
+            side = '<%s style="thin"><color auto="1"/></%s>'
+            border = "".join(side % (s, s) for s in ("left", "right", "top", "bottom")) if v else ""
+        elif k == "top":
+            border = '<left/><right/><top style="thin"><color auto="1"/></top><bottom/>' if v else ""
+        elif k == "align":
+            alignment.append('horizontal="' + v + '"')
+        elif k == "valign":
+            alignment.append('vertical="' + v.replace("vcenter", "center") + '"')
+        elif k == "text_wrap":
+            alignment.append('wrapText="1"') if v else None
+        elif k == "locked":
+            protection.append('locked="0"') if not v else None
+        elif k == "hidden":
+            protection.append('hidden="1"') if v else None
+        else:
+            raise ValueError("The direct writer doesn't support the format property " + k)
+
+    return font, fill, border, " ".join(alignment), " ".join(protection)
+
+
+# Builds styles.xml from STYLES, with the xf of STYLES[i] at index i + 1 (0 is the default style)
+def make_styles_xml():
+    font_tail = '<sz val="11"/><name val="Calibri"/><family val="2"/><scheme val="minor"/>'
+    fonts = [""]
+    fills = ['<patternFill patternType="none"/>', '<patternFill patternType="gray125"/>']
+    borders = [""]
+    xfs = ['<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>']
+
+    for _, properties in STYLES:
+        font, fill, border, alignment, protection = style_parts(properties)
+        for part, table in ((font, fonts), (fill, fills), (border, borders)):
+            if part and part not in table:
+                table.append(part)
+
+        xf = '<xf numFmtId="0" fontId="%d" fillId="%d" borderId="%d" xfId="0"' % (
+            fonts.index(font), fills.index(fill) if fill else 0, borders.index(border))
+        xf += ' applyFont="1"' if font else ""
+        xf += ' applyFill="1"' if fill else ""
+        xf += ' applyBorder="1"' if border else ""
+        xf += ' applyAlignment="1"' if alignment else ""
+        xf += ' applyProtection="1"' if protection else ""
+        inner = ("<alignment " + alignment + "/>" if alignment else "") + \
+                ("<protection " + protection + "/>" if protection else "")
+        xfs.append(xf + (">" + inner + "</xf>" if inner else "/>"))
+
+    empty_border = "<left/><right/><top/><bottom/>"
+    return XML_HEADER + '<styleSheet xmlns="' + MAIN_NS + '">' + \
+        '<fonts count="%d">' % len(fonts) + "".join("<font>" + f + font_tail + "</font>" for f in fonts) + \
+        "</fonts>" + \
+        '<fills count="%d">' % len(fills) + "".join("<fill>" + f + "</fill>" for f in fills) + "</fills>" + \
+        '<borders count="%d">' % len(borders) + \
+        "".join("<border>" + (b or empty_border) + "<diagonal/></border>" for b in borders) + "</borders>" + \
+        '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>' + \
+        '<cellXfs count="%d">' % len(xfs) + "".join(xfs) + "</cellXfs>" + \
+        '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>' + \
+        "</styleSheet>"
+
+
+# Built on first use, the same for every report
+STYLES_XML = []
+
+
+# A format handed out by DirectWorkbook.add_format, only carries its precomputed xf index
+class DirectFormat():
+    def __init__(self, index):
+        self.index = index
+
+
+# The part of xlsxwriter's Worksheet API that Create uses, writing each cell straight to its XML
+class DirectWorksheet():
+    def __init__(self, index):
+        self.index = index
+        self.rows = {}
+        self.row_heights = {}
+        self.columns = {}
+        self.merged = []
+        self.protected = False
+
+    def protect(self):
+        self.protected = True
+
+    def set_row(self, row, height):
+        self.row_heights[row] = height
+
+    # Like xlsxwriter, columns are keyed by their first column, so a later call with the same start replaces it
+    def set_column(self, first_col, last_col, width):
+        if first_col > last_col:
+            first_col, last_col = last_col, first_col
+        self.columns[first_col] = (last_col, width)
+
+    def merge_range(self, cell_range, data, cell_format=None):
+        first, last = cell_range.split(":")
+        r, c = ln_to_rc(first)
+        r1, c1 = ln_to_rc(last)
+        for row in range(r, r1 + 1):
+            for col in range(c, c1 + 1):
+                self.write_blank(row, col, cell_format)
+        self.write(r, c, data, cell_format)
+        self.merged.append(cell_range)
+
+    def write_row(self, row, col, data, cell_format=None):
+        data = tuple(data)
+        s = cell_format.index if cell_format else 0
+
+        # Header rows are stamped over and over, so their cells are rendered once and reused
+        # Only plain text takes this path, formulas and blanks go through write() like they do in xlsxwriter
+        if all(isinstance(x, basestring) and x and not x.startswith("=") for x in data):
+            key = (col, data, s)
+            fragments = FRAGMENTS.get(key)
+            if fragments is None:
+                fragments = [self.string_cell("", x, s)[len('<c r="'):] for x in data]
+                if len(FRAGMENTS) < FRAGMENTS_LIMIT:
+                    FRAGMENTS[key] = fragments
+            cells = self.rows.setdefault(row, {})
+            for i, fragment in enumerate(fragments):
+                cells[col + i] = '<c r="' + col_letters(col + i) + str(row + 1) + fragment
+            return
+
+        for i, x in enumerate(data):
+            self.write(row, col + i, x, cell_format)
+
+    # Same type handling as xlsxwriter's write(): "=" strings are formulas, empty strings and None are blanks
+    def write(self, row, col, data, cell_format=None):
+        s = cell_format.index if cell_format else 0
+        if data is None or data == "":
+            self.write_blank(row, col, cell_format)
+        elif isinstance(data, bool):
+            self.set_cell(row, col, '<c r="%s" s="%d" t="b"><v>%d</v></c>', s, int(data))
+        elif isinstance(data, (int, long, float)):
+            self.set_cell(row, col, '<c r="%s" s="%d"><v>%.16G</v></c>', s, data)
+        elif isinstance(data, basestring) and data.startswith("="):
+            self.write_formula(row, col, data, cell_format)
+        else:
+            self.rows.setdefault(row, {})[col] = self.string_cell(col_letters(col) + str(row + 1), data, s)
+
+    def write_formula(self, row, col, formula, cell_format=None):
+        s = cell_format.index if cell_format else 0
+        self.set_cell(row, col, '<c r="%s" s="%d"><f>%s</f><v>0</v></c>', s, xml_escape(formula.lstrip("=")))
+
+    def write_blank(self, row, col, cell_format=None):
+        # Blank cells without a format don't need to exist at all
+        if cell_format:
+            self.rows.setdefault(row, {})[col] = '<c r="%s" s="%d"/>' % (col_letters(col) + str(row + 1),
+                                                                        cell_format.index)
+
+    def set_cell(self, row, col, xml, s, value):
+        self.rows.setdefault(row, {})[col] = xml % (col_letters(col) + str(row + 1), s, value)
 
-        page.set_column(1, 0, 20)
-        page.set_column(2, 0, 12)
-        page.set_column(3, 0, 15)
-        page.set_column(4, 0, 20)
-        page.set_column(5, 0, 15)
-        page.set_column(7, 0, 15)
-        page.set_column(8, 0, 15)
-        page.set_column(9, 0, 15)
+    @staticmethod
+    def string_cell(ref, text, s):
+        if not isinstance(text, unicode):
+            text = str(text).decode("utf-8")
+        space = ' xml:space="preserve"' if text != text.strip() else ""
+        return '<c r="%s" s="%d" t="inlineStr"><is><t%s>%s</t></is></c>' % (ref, s, space, xml_escape(text))
+
+    # Writes the full sheet XML to out, rows in order
+    # Every cell's XML is already held in self.rows, this only avoids joining them into one more big string
+    def write_xml(self, out):
+        parts = [XML_HEADER, '<worksheet xmlns="', MAIN_NS, '" xmlns:r="', REL_NS, '">']
+
+        if self.rows:
+            rows = sorted(self.rows)
+            cols = [c for cells in self.rows.values() for c in cells]
+            parts.append('<dimension ref="%s%d:%s%d"/>' % (col_letters(min(cols)), rows[0] + 1,
+                                                           col_letters(max(cols)), rows[-1] + 1))
+        else:
+            parts.append('<dimension ref="A1"/>')
+
+        tab = ' tabSelected="1"' if self.index == 1 else ""
+        parts.append('<sheetViews><sheetView%s workbookViewId="0"/></sheetViews>' % tab)
+        parts.append('<sheetFormatPr defaultRowHeight="15"/>')
+
+        if self.columns:
+            parts.append("<cols>")
+            for first_col in sorted(self.columns):
+                last_col, width = self.columns[first_col]
+                # Excel's character width to saved width conversion, for Calibri 11
+                width = int((int(width * 7 + 0.5) + 5) / 7.0 * 256.0) / 256.0
+                parts.append('<col min="%d" max="%d" width="%.16g" customWidth="1"/>' % (first_col + 1,
+                                                                                         last_col + 1, width))
+            parts.append("</cols>")
+
+        parts.append("<sheetData>")
+        out.write("".join(parts))
+
+        for row in sorted(set(self.rows) | set(self.row_heights)):
+            if row in self.row_heights:
+                line = '<row r="%d" ht="%.16g" customHeight="1">' % (row + 1, self.row_heights[row])
+            else:
+                line = '<row r="%d">' % (row + 1)
+            cells = self.rows.get(row, {})
+            line += u"".join(cells[c] for c in sorted(cells)) + "</row>"
+            out.write(line.encode("utf-8"))
+
+        parts = ["</sheetData>"]
+
+        if self.protected:
+            parts.append('<sheetProtection sheet="1" objects="1" scenarios="1"/>')
+        if self.merged:
+            parts.append('<mergeCells count="%d">' % len(self.merged))
+            parts.extend('<mergeCell ref="%s"/>' % m for m in self.merged)
+            parts.append("</mergeCells>")
+        parts.append('<pageMargins left="0.7" right="0.7" top="0.75" bottom="0.75" header="0.3" footer="0.3"/>')
+        parts.append("</worksheet>")
+        out.write("".join(parts))
+
+
+# Minimal stand in for xlsxwriter.Workbook that only knows the layout Create writes
+# Formats must come from STYLES (their style indices are precomputed) and strings are written inline
+# Cells are kept in memory until the workbook is closed, then each sheet goes through a temp file into the zip,
+# so peak memory is about the same as xlsxwriter's, the gain is in speed
+class DirectWorkbook():
+    def __init__(self, filename):
+        self.filename = filename
+        self.worksheets = []
+
+    def add_format(self, properties):
+        for i, (_, style) in enumerate(STYLES):
+            if style == properties:
+                return DirectFormat(i + 1)
+        raise ValueError("The direct writer only supports the formats in STYLES")
+
+    def add_worksheet(self):
+        page = DirectWorksheet(len(self.worksheets) + 1)
+        self.worksheets.append(page)
+        return page
+
+    def close(self):
+        import tempfile
+        import zipfile
+
+        if not STYLES_XML:
+            STYLES_XML.append(make_styles_xml())
+
+        n = len(self.worksheets)
+        content_types = XML_HEADER + \
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">' \
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>' \
+            '<Default Extension="xml" ContentType="application/xml"/>' \
+            '<Override PartName="/xl/workbook.xml" ' \
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>' \
+            '<Override PartName="/xl/styles.xml" ' \
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>' + \
+            "".join('<Override PartName="/xl/worksheets/sheet%d.xml" '
+                    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>' % i
+                    for i in range(1, n + 1)) + \
+            "</Types>"
+
+        root_rels = XML_HEADER + \
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">' \
+            '<Relationship Id="rId1" Type="' + REL_NS + '/officeDocument" Target="xl/workbook.xml"/>' \
+            '</Relationships>'
+
+        workbook = XML_HEADER + '<workbook xmlns="' + MAIN_NS + '" xmlns:r="' + REL_NS + '"><sheets>' + \
+            "".join('<sheet name="Sheet%d" sheetId="%d" r:id="rId%d"/>' % (i, i, i) for i in range(1, n + 1)) + \
+            '</sheets><calcPr calcId="124519" fullCalcOnLoad="1"/></workbook>'
+
+        workbook_rels = XML_HEADER + \
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">' + \
+            "".join('<Relationship Id="rId%d" Type="%s/worksheet" Target="worksheets/sheet%d.xml"/>' % (i, REL_NS, i)
+                    for i in range(1, n + 1)) + \
+            '<Relationship Id="rId%d" Type="%s/styles" Target="styles.xml"/>' % (n + 1, REL_NS) + \
+            '</Relationships>'
+
+        f = zipfile.ZipFile(self.filename, "w", zipfile.ZIP_DEFLATED)
+        try:
+            f.writestr("[Content_Types].xml", content_types)
+            f.writestr("_rels/.rels", root_rels)
+            f.writestr("xl/workbook.xml", workbook)
+            f.writestr("xl/_rels/workbook.xml.rels", workbook_rels)
+            f.writestr("xl/styles.xml", STYLES_XML[0])
+            for page in self.worksheets:
+                tmp = tempfile.NamedTemporaryFile(suffix=".xml", delete=False)
+                try:
+                    page.write_xml(tmp)
+                    tmp.close()
+                    f.write(tmp.name, "xl/worksheets/sheet%d.xml" % page.index)
+                finally:
+                    tmp.close()
+                    os.remove(tmp.name)
+                # Nothing else needs the cells once they're in the zip
+                page.rows = {}
+        finally:
+            f.close()
+
+
+# Market symbol lookups
+MARKET_SYMBOLS = {
+    "alfalfa": ["alfalfa"],
+    "cane": ["cane"],
+    "corn": ["corn_enogen", "corn_enogen_dryland", "corn_white",
+             "corn_white_dryland", "corn_yellow", "corn_yellow_dryland"],
+    "corn_pink": ["corn_pink"],
+    "cotton": ["cotton"],
+    "oats": ["oats", "oats_dryland"],
+    "soybeans": ["soybeans", "soybean_dryland", "soybean_meal",
+                 "soybean_meal_dryland", "soybean_oil", "soybean_oil_dryland"],
+    "wheat": ["wheat", "wheat_dryland", "wheat_red",
+              "wheat_red_dryland", "wheat_spring", "wheat_spring_dryland"]
+}
+
+# Columns pulled from insurances for a policy
+POLICY_HEADERS = ["id", "farm_id", "farm_crop_id", "units",
+                  "combined_market_symbol", "hpp_coverage",
+                  "county_id", "practice", "hpp_practice", "MPCI_coverage",
+                  "percent_of_spring_price", "county_id"]
+
+# Every query Generate runs, kept in one place so the index advisor explains exactly what Generate executes
+QUERIES = {
+    "policy": "SELECT " + ", ".join(POLICY_HEADERS) + " FROM insurances WHERE id = %(policy_id)s;",
+
+    # Generating the County,State string for "County" key
+    "county": "SELECT (county_name, state) "
+              "FROM counties "
+              "WHERE id = %(county_id)s;",
+
+    "farm_crops": "SELECT DISTINCT farm_crops.id "
+                  "FROM farm_crops, crops "
+                  "WHERE crops.market_symbol = ANY(%(market_symbols)s) "
+                  "AND farm_crops.crop_id = crops.id "
+                  "AND farm_crops.farm_id = %(farm_id)s;",
+
+    # Every zone on the policy's farm and county growing one of the policy's farm_crops, with its prices
+    # Columns 0-7 are the zone's own info, 8-9 the prices in cents, 10 irrigated and 11-13 its legal description
+    "policy_zones": "SELECT fields.name, zones.name, zones.fsa_acres, "
+                    "zones.yield_goal, zones.fsa_acres, zones.loss_percent, zones.aph, zones.id, "
+                    "farm_crops.harvest_price_cents, farm_crops.spring_price_cents, "
+                    "zones.irrigated, zones.section, zones.township, zones.range "
+                    "FROM insurances, farms, fields, zones, farm_crops "
+                    "WHERE insurances.id = %(policy_id)s "
+                    "AND farms.id = insurances.farm_id "
+                    "AND fields.farm_id = farms.id "
+                    "AND zones.field_id = fields.id "
+                    "AND zones.county_id = insurances.county_id "
+                    "AND zones.farm_crop_id = ANY(%(farm_crops)s) "
+                    "AND farm_crops.id = zones.farm_crop_id "
+                    "ORDER BY zones.id;",
+
+    # Hash of every input row a policy's results depend on, used to skip refreshing unchanged policies
+    # crops are included because their market_symbol decides which farm_crops, and so which zones, a policy covers
+    "inputs_hash": "SELECT md5(string_agg(x, ',' ORDER BY x)) FROM ("
+                   "SELECT insurances::text AS x FROM insurances WHERE id = %(policy_id)s "
+                   "UNION ALL "
+                   "SELECT counties::text FROM insurances, counties "
+                   "WHERE insurances.id = %(policy_id)s AND counties.id = insurances.county_id "
+                   "UNION ALL "
+                   "SELECT farm_crops::text FROM insurances, farm_crops "
+                   "WHERE insurances.id = %(policy_id)s AND farm_crops.farm_id = insurances.farm_id "
+                   "UNION ALL "
+                   "SELECT crops::text FROM insurances, farm_crops, crops "
+                   "WHERE insurances.id = %(policy_id)s AND farm_crops.farm_id = insurances.farm_id "
+                   "AND crops.id = farm_crops.crop_id "
+                   "UNION ALL "
+                   "SELECT fields::text FROM insurances, fields "
+                   "WHERE insurances.id = %(policy_id)s AND fields.farm_id = insurances.farm_id "
+                   "UNION ALL "
+                   "SELECT zones::text FROM insurances, fields, zones "
+                   "WHERE insurances.id = %(policy_id)s "
+                   "AND fields.farm_id = insurances.farm_id "
+                   "AND zones.field_id = fields.id "
+                   "AND zones.county_id = insurances.county_id) inputs;"
+}
+
+
+# Materialized Generate output for other systems to read, see Generate.store_results
+# Money columns are plain numbers (the spreadsheet's currency strings are only made for display)
+RESULTS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS unit_results (
+    insurance_id integer NOT NULL,
+    sheet text NOT NULL,
+    legal text NOT NULL,
+    total_acres double precision,
+    total_bushel_guarantee double precision,
+    mpci_loss double precision,
+    potential_dollar_loss double precision,
+    actual_dollar_loss double precision,
+    gen jsonb NOT NULL,
+    refreshed_at timestamptz NOT NULL DEFAULT now(),
+    PRIMARY KEY (insurance_id, sheet, legal));
+CREATE TABLE IF NOT EXISTS zone_results (
+    insurance_id integer NOT NULL,
+    sheet text NOT NULL,
+    zone_id integer NOT NULL,
+    legal text NOT NULL,
+    field_zone text,
+    acres double precision,
+    actual_production double precision,
+    actual_yield double precision,
+    refreshed_at timestamptz NOT NULL DEFAULT now(),
+    PRIMARY KEY (insurance_id, sheet, zone_id));
+CREATE TABLE IF NOT EXISTS results_refreshes (
+    insurance_id integer PRIMARY KEY,
+    inputs_hash text NOT NULL,
+    refreshed_at timestamptz NOT NULL DEFAULT now());
+"""
+
+
+# Works out one legal unit from its zones, independent of every other unit
+class UnitCalculator():
+    def __init__(self, policy, verbose, very_verbose):
+        self.policy = policy
+        self.verbose = verbose
+        self.very_verbose = very_verbose
 
-        # Headers for the general info
-        gen_h = ["Total Acres", "Modified APH", "MPCI Yield Guarantee","Covered Bushels", "guarantee/acre",
-                 "Loss Percent", "Potential Bushel Loss", "Potential Dollar Loss", "Actual Dollar Loss"]
+    # zones is the unit's list of zone_table entries (see Generate.main)
+    # Returns (unit name, unit for the data set, raw gen for unit_results, zone_results rows,
+    #          (harvest price, spring price))
+    def calculate(self, sheet, legal_name, zones):
+        # Running totals used for "gen" information
+        total_acres = 0.0
+        actual_production_total = 0
 
-        # Headers for the zone section
-        h_order = ["Field-Zone", "Acres", "Actual Production", "Actual Yield"]
+        name = "Unit - " + str(legal_name[0]) + " " + str(legal_name[1]) + " " + str(legal_name[2])
+        legal = " ".join(str(x) for x in legal_name)
 
-        # Row counter
-        r = 2
-        units = sorted(data["units"].keys(), key=lambda a: int(a.split(" ")[2]))
-        for name in units:
-            unit = data["units"][name]
+        # Gets the general info for this section from UNIT_GENS, and then sets them all to 0 in a dictionary
+        unit_gen = UNIT_GENS[sheet]
+        gens = dict(zip(unit_gen, [0]*len(unit_gen)))
+        unit = {"gen": gens, "zones": []}
 
-            page.write(r, 0, name, self.format_01)
+        new_l = []
+        zone_results = []
+        for result, zone in zones:
+            new_l.append(dict(zone))
+            zone_results.append((sheet, result[7], legal, zone["Field-Zone"], zone["Acres"],
+                                 zone["Actual Production"], zone["Actual Yield"]))
+            total_acres += float(zone["Acres"])
+            actual_production_total += zone["Actual Production"]
+
+        # Generating general parts of the data set used by all units
+        gen_dict = unit["gen"]
+        gen_dict["Total Acres"] = float(total_acres)
+        self.vv_print("Total Acres: " + str(gen_dict["Total Acres"]))
+        self.vv_print("")
+
+        gen_dict["MPCI Yield Guarantee"] = result[6] * (self.policy["MPCI_coverage"] / 100.0)
+        self.vv_print("MPCI Yield Guarantee: " + str(gen_dict["MPCI Yield Guarantee"]))
+        self.vv_print("^ = zones.aph * (mpci_coverage / 100.0)")
+        self.vv_print("^ = " + str(result[6]) + " * " + "(" + str(self.policy["MPCI_coverage"]) + " / " + "100.0")
+        self.vv_print("")
+
+        # The harvest prices and spring prices (in cents), from the unit's last zone
+        harvest_price = result[8]
+        spring_price = result[9]
+        production_total = actual_production_total / float(total_acres)
+        self.vv_print("Production Total: " + str(production_total))
+        self.vv_print("^ = actual_production_toal / total_acres")
+        self.vv_print("^ = " + str(actual_production_total) + " / " + str(float(total_acres)))
+        self.vv_print("")
+
+        # Generating unit-specific data
+        # If we're working with Optional or Enterprise
+        if sheet != "hpp_units":
+            self.v_print("Generating enterprise and optional calculations..")
+            self.v_print("--------------------------------------------------")
+
+            gen_dict["APH"] = result[6]
+            if gen_dict["MPCI Yield Guarantee"] > 0:
+                gen_dict["guarantee/acre"] = (spring_price / 100.0) * gen_dict["MPCI Yield Guarantee"]
+                _a = "^ = (spring_price / 100.0) * mpci_yield_guarantee"
+                _b = "^ = (" + str(spring_price) + " / 100.0) * " + str(gen_dict["MPCI Yield Guarantee"])
+            else:
+                gen_dict["guarantee/acre"] = 0
+                _a = "^ = 0"
+                _b = "^ = 0"
+            self.vv_print("guarantee/acre = " + str(gen_dict["guarantee/acre"]))
+            self.vv_print(_a)
+            self.vv_print(_b)
+            self.vv_print("")
+
+            gen_dict["Total Bushel Guarantee"] = gen_dict["MPCI Yield Guarantee"] * total_acres
+            self.vv_print("Total Bushel Guarantee: " + str(gen_dict["Total Bushel Guarantee"]))
+            self.vv_print("^ = MPCI Yield Guarantee * Total Acres")
+            self.vv_print("^ = " + str(gen_dict["MPCI Yield Guarantee"]) + " * " + str(total_acres))
+            self.vv_print("")
+
+            # Calculates trigger_yield, which is used in future calculations
+            if harvest_price < spring_price:
+                b = float(gen_dict["guarantee/acre"] / float(harvest_price))
+                _a = "^ = guarantee/acre / harvest_price"
+                _b = "^ = " + str(gen_dict["guarantee/acre"]) + " / " + str(float(harvest_price))
+            else:
+                b = gen_dict["MPCI Yield Guarantee"]
+                _a = "^ = MPCI Yield Guarantee"
+                _b = "^ = " + str(gen_dict["MPCI Yield Guarantee"])
+            trigger_yield = b
+            self.vv_print("Trigger Yield: " + str(trigger_yield))
+            self.vv_print(_a)
+            self.vv_print(_b)
+            self.vv_print("")
+
+            if trigger_yield > production_total:
+                a = trigger_yield - production_total
+                _a = "^ = trigger_yield - production_total"
+                _b = "^ = " + str(trigger_yield) + " - " + str(production_total)
+            else:
+                a = 0
+                _a = "^ = 0"
+                _b = "^ = 0"
+
+            gen_dict["MPCI Bushel Loss per acre"] = a
+            self.vv_print("MPCI Bushel Loss per acre: " + str(gen_dict["MPCI Bushel Loss per acre"]))
+            self.vv_print(_a)
+            self.vv_print(_b)
+            self.vv_print("")
+
+            _a = (harvest_price / 100.0) * gen_dict["MPCI Bushel Loss per acre"] * total_acres
+            gen_dict["MPCI Loss"] = _a
+            self.vv_print("MPCI Loss: " + str(gen_dict["MPCI Loss"]))
+            self.vv_print("^ = (harvest_price / 100.0) * MPCI Bushel Loss per acre * total_acres")
+            self.vv_print("^ = (" + str(harvest_price / 100.0) + ") * "
+                          + str(gen_dict["MPCI Bushel Loss per acre"]) + " * " + str(total_acres))
+            self.vv_print("")
+
+            # Keeps the raw numbers for unit_results before they become strings
+            unit_result = (sheet, legal, dict(gen_dict))
+
+            # Converting to currency - Doing it after everything because calculations require solid numbers
+            gen_dict["guarantee/acre"] = Generate.to_currency(gen_dict["guarantee/acre"])
+            gen_dict["MPCI Loss"] = Generate.to_currency(gen_dict["MPCI Loss"])
+
+            # Rounding - We round after calculations to ensure accuracy in the calculations
+            gen_dict["MPCI Bushel Loss per acre"] = round(gen_dict["MPCI Bushel Loss per acre"], 2)
+
+        # If we're working with HPP
+        else:
+            self.v_print("Generating hpp calculations..")
+            self.v_print("-----------------------------------------")
+
+            percent_spring_price = (spring_price / 100.0) * (self.policy["percent_of_spring_price"] / 100.0)
+            self.v_print("% of sprint price: " + str(percent_spring_price))
+            self.vv_print("^ = (spring_price / 100.0) * (percent_of_spring_price / 100.0")
+            self.vv_print("^ = (" + str(spring_price / 100.0) +
+                          str(self.policy["percent_of_spring_price"]) + " / 100.0")
+            self.v_print("")
+
+            gen_dict["Modified APH"] = result[6] * (self.policy["hpp_coverage"] / 100.0)
+            self.v_print("Modified APH: " + str(gen_dict["Modified APH"]))
+            self.vv_print("^ = zones.aph * (hpp_coverage / 100.0)")
+            self.vv_print("^ = " + str(result[6]) + " * " + str(self.policy["hpp_coverage"]) + " / 100.0")
+            self.v_print("")
+
+            _a = gen_dict["Modified APH"] - result[6] * (self.policy["MPCI_coverage"] / 100.0)
+            gen_dict["Covered Bushels"] = _a
+            self.v_print("Covered Bushels: " + str(_a))
+            self.vv_print("^ = Modified APH - zones.aph * (mpci_coverage / 100.0)")
+            self.vv_print("^ = " + str(gen_dict["Modified APH"]) + " - " + str(result[6]))
+
+            gen_dict["guarantee/acre"] = percent_spring_price * gen_dict["Covered Bushels"]
+            gen_dict["Loss Percent"] = result[5]
+
+            # Calculates potential_bushel_loss
+            total_bushel_loss = gen_dict["Modified APH"] * gen_dict["Loss Percent"]
+            if gen_dict["Covered Bushels"] > total_bushel_loss:
+                _a = total_bushel_loss
+            else:
+                _a = gen_dict["Covered Bushels"]
+            gen_dict["Potential Bushel Loss"] = _a
+
+            # Uses "_a" as a temporary variable to save space and abide by PEP8 line-length standards
+            _a = percent_spring_price * gen_dict["Potential Bushel Loss"] * gen_dict["Total Acres"]
+            gen_dict["Potential Dollar Loss"] = _a
+
+            # Calculates actual_$_loss
+            if production_total > gen_dict["Modified APH"]:
+                _a = 0
+            elif production_total > gen_dict["Modified APH"] - gen_dict["Potential Bushel Loss"]:
+                if gen_dict["Modified APH"] - production_total < gen_dict["Potential Bushel Loss"]:
+                    _a = percent_spring_price * (gen_dict["Modified APH"] - production_total) * total_acres
+                else:
+                    _a = percent_spring_price * gen_dict["Potential Bushel Loss"] * total_acres
+            else:
+                _a = gen_dict["Potential Dollar Loss"]
+            gen_dict["Actual Dollar Loss"] = _a
 
-            # General unit information
+            # Keeps the raw numbers for unit_results before they become strings
+            unit_result = (sheet, legal, dict(gen_dict))
 
-            values = [unit["gen"][x] for x in gen_h]
+            # Converting to currency - Doing it after everything because calculations require solid numbers
+            gen_dict["guarantee/acre"] = Generate.to_currency(gen_dict["guarantee/acre"])
+            gen_dict["Potential Dollar Loss"] = Generate.to_currency(gen_dict["Potential Dollar Loss"])
+            gen_dict["Actual Dollar Loss"] = Generate.to_currency(gen_dict["Actual Dollar Loss"])
 
-            page.write_row(r+1, 1, gen_h[:4], self.format_01)
-            page.write_row(r+2, 1, values[:4])
-            acres_row = r+2
+        # Adds the list of zones for this unit
+        unit["zones"] = new_l
 
-            page.write_row(r+4, 1, gen_h[4:], self.format_01)
-            page.write_row(r+5, 1, values[4:])
+        self.v_print("Finished calculations for " + sheet + "..")
 
-            # Sets the headers for our zone columns
+        return name, unit, unit_result, zone_results, (harvest_price, spring_price)
 
-            page.write_row(r+8, 1, h_order, self.format_01)
+    # Used for printing status messages if self.verbose is enabled
+    def v_print(self, message):
+        if self.verbose:
+            print message
 
-            # Which fields are unlocked
-            field_unlock = ["Acres"]
+    # Used for printing more cumbersome status messages if self.very_verbose is enabled
+    def vv_print(self, message):
+        if self.very_verbose:
+            print message
 
-            # Total dictionary
-            totals = dict(zip(h_order, [[] for _ in xrange(len(h_order))]))
 
-            r += 9
-            # Writes each value for the zone, unlocks fields that are in field_unlock
-            for zone in unit["zones"]:
-                for i, h in enumerate(h_order):
-                    if h in field_unlock:
-                        page.write(r, i+1, zone[h], self.unlocked)
-                    else:
-                        page.write(r, i+1, zone[h])
-                    cell = rc_to_ln(r, i+1)
-                    totals[h].append(cell)
-                r += 1
+# Current hash of a policy's inputs, see QUERIES["inputs_hash"]
+def policy_inputs_hash(cur, policy_id):
+    cur.execute(QUERIES["inputs_hash"], {"policy_id": policy_id})
+    return cur.fetchone()[0]
 
-            # Creates the SUM formulas for each unit
-            for h in h_order:
-                _sum = "=SUM("+",".join(totals[h])+")"
-                totals[h] = _sum
 
-            # Totals writing
-            page.write(r, 1, "Totals: ", self.format_03)
-            for i, c in enumerate(range(2, 5)):
-                _formula = totals[h_order[i+1]]
-                page.write_formula(r, c, _formula, self.format_03)
+# Recomputes unit_results for the given policies (every policy if None) whose inputs changed since their last refresh
+# Refreshing every policy also drops the results of policies that no longer exist
+# Returns the ids that were refreshed
+def refresh_results(dsn, policy_ids=None, force=False, verbose=False, very_verbose=False):
+    import psycopg2
 
-            # Writes the total acres formula to the general info, too
-            page.write_formula(acres_row, 1, totals["Acres"], self.format_03)
-            r += 3
+    # Only used for checks between Generate runs (each has its own connection), so it never sits in a transaction
+    try:
+        conn = psycopg2.connect(dsn)
+        conn.autocommit = True
+        cur = conn.cursor()
+    except psycopg2.OperationalError as e:
+        Generate.return_error("Something went wrong when trying to connect to the database.", e)
 
-    # Used for printing status messages if self.verbose is enabled
-    def v_print(self, message):
-        if self.verbose:
-            print message
+    cur.execute(RESULTS_SCHEMA)
+
+    if policy_ids is None:
+        # Sent as one statement string, so the three deletes commit together
+        cur.execute("DELETE FROM unit_results WHERE insurance_id NOT IN (SELECT id FROM insurances); "
+                    "DELETE FROM zone_results WHERE insurance_id NOT IN (SELECT id FROM insurances); "
+                    "DELETE FROM results_refreshes WHERE insurance_id NOT IN (SELECT id FROM insurances);")
+
+        cur.execute("SELECT id FROM insurances ORDER BY id;")
+        policy_ids = [x[0] for x in cur.fetchall()]
+
+    refreshed = []
+    for policy_id in policy_ids:
+        # Taken before Generate reads anything, so it's handed the hash instead of working it out again
+        inputs_hash = None
+        if not force:
+            inputs_hash = policy_inputs_hash(cur, policy_id)
+            cur.execute("SELECT inputs_hash FROM results_refreshes WHERE insurance_id = %s;", (policy_id,))
+            row = cur.fetchone()
+            if row is not None and row[0] == inputs_hash:
+                continue
+
+        Generate(verbose, very_verbose, policy_id, dsn, True, inputs_hash=inputs_hash)
+        refreshed.append(policy_id)
+
+    conn.close()
+    return refreshed
+
+
+# General information shells for each legal unit
+UNIT_GENS = {"hpp_units": ["Total Acres", "Modified APH", "MPCI Yield Guarantee",
+                           "Covered Bushels", "guarantee/acre", "Loss Percent",
+                           "Potential Bushel Loss", "Potential Dollar Loss", "Actual Dollar Loss"],
+
+             "optional_units": ["Total Acres", "APH", "Yield Guarantee",
+                                "guarantee/acre", "Total Bushel Guarantee",
+                                "MPCI Bushel Loss per acre", "MPCI Loss"],
+
+             "enterprise_units": ["Total Acres", "APH", "Yield Guarantee",
+                                  "guarantee/acre", "Total Bushel Guarantee",
+                                  "MPCI Bushel Loss per acre", "MPCI Loss"]}
 
 
 # Generates our data set to pass over to the Create class
+# The inputs are only fingerprinted (see QUERIES["inputs_hash"]) when that's needed, for save_results or fingerprint,
+# and not at all if the caller already took the hash before calling
 class Generate():
-    def __init__(self, verbose, very_verbose):
+    def __init__(self, verbose, very_verbose, policy_id="24", dsn=DEFAULT_DSN, save_results=False,
+                 fingerprint=False, inputs_hash=None):
         self.verbose = verbose
         self.very_verbose = very_verbose
+        self.policy_id = str(policy_id)
+        self.dsn = dsn
+        self.save_results = save_results
+        self.fingerprint = fingerprint
         self.dictionary = {}
+
+        # Fingerprint of the inputs the data set is calculated from
+        self.inputs_hash = inputs_hash
+
+        # Unrounded per-unit and per-zone numbers, written to unit_results/zone_results when save_results is set
+        self.unit_results = []
+        self.zone_results = []
+
         self.main()
 
     def main(self):
-        self.v_print("Beginning data set fabrication..")
+        import psycopg2
 
-        # Market symbol lookups
-        market_symbols = {
-            "alfalfa": ["alfalfa"],
-            "cane": ["cane"],
-            "corn": ["corn_enogen", "corn_enogen_dryland", "corn_white",
-                     "corn_white_dryland", "corn_yellow", "corn_yellow_dryland"],
-            "corn_pink": ["corn_pink"],
-            "cotton": ["cotton"],
-            "oats": ["oats", "oats_dryland"],
-            "soybeans": ["soybeans", "soybean_dryland", "soybean_meal",
-                         "soybean_meal_dryland", "soybean_oil", "soybean_oil_dryland"],
-            "wheat": ["wheat", "wheat_dryland", "wheat_red",
-                      "wheat_red_dryland", "wheat_spring", "wheat_spring_dryland"]
-        }
+        self.v_print("Beginning data set fabrication..")
 
         # DB Connection
         self.v_print("Attempting database connection..")
 
         # Attempts database connection, errors out if it fails
         try:
-            conn = psycopg2.connect("dbname=DB2 user=brandonsturgeon password=brandon1 host=localhost")
+            conn = psycopg2.connect(self.dsn)
             cur = conn.cursor()
             self.v_print("Database connection successful..")
         except psycopg2.OperationalError as e:
@@ -379,19 +1097,16 @@ class Generate():
                      "Practice": ""}}
 
         # Creates object with policy info
-        policy_id = "24"
-        headers = ["id", "farm_id", "farm_crop_id", "units",
-                   "combined_market_symbol", "hpp_coverage",
-                   "county_id", "practice", "hpp_practice", "MPCI_coverage",
-                   "percent_of_spring_price", "county_id"]
+        policy_id = self.policy_id
 
-        # Converts headers list into a string to plug into a query
-        t_str = str(headers).replace("'", "").strip("[]")
+        # Fingerprints the inputs before reading any of them, so if they change while we read, the stored hash
+        # is the older one and the next refresh recalculates instead of keeping results from half old rows
+        if self.inputs_hash is None and (self.save_results or self.fingerprint):
+            self.inputs_hash = policy_inputs_hash(cur, policy_id)
 
         # Query to get our policy dictionary
-        a = "SELECT " + t_str + " FROM insurances WHERE id = %s;"
-        cur.execute(a, (policy_id,))
-        policy = dict(zip(headers, cur.fetchone()))
+        cur.execute(QUERIES["policy"], {"policy_id": policy_id})
+        policy = dict(zip(POLICY_HEADERS, cur.fetchone()))
 
         # Plugging info into dictionary for the policy_info page
         p_info = data_set["policy_info"]
@@ -400,10 +1115,7 @@ class Generate():
         p_info["MPCI Coverage"] = str(policy["MPCI_coverage"]) + "%"
         p_info["Practice"] = policy["practice"]
         # Generating the County,State string for "County" key
-        a = "SELECT (county_name, state) "\
-            "FROM counties "\
-            "WHERE id = %s;"
-        cur.execute(a, (policy["county_id"],))
+        cur.execute(QUERIES["county"], {"county_id": policy["county_id"]})
         p_info["County"] = cur.fetchone()[0].strip("()")
         p_info["Percent of Spring Price"] = str(policy["percent_of_spring_price"]) + "%"
         # Policy info stuff that only shows up if HPP exists
@@ -434,321 +1146,125 @@ class Generate():
         data_set[u] = {"units": {}}
         usable_units.append(u)
 
-        # Generates the crop name Array to be used in farm_crop query
-        m_symb = policy["combined_market_symbol"]
-        t_str = "ANY(ARRAY"
-        t_str += str(market_symbols[m_symb]).replace("\"", "'") + ")"
-        # print "Crop Names: " + t_str
-
         self.v_print("Doing DB lookup to retrieve farm_crop ID's..")
         # Gets the farm_crop IDs with same farm_id and market symbols
-        a = "SELECT DISTINCT farm_crops.id " \
-            "FROM farm_crops, crops " \
-            "WHERE crops.market_symbol = " + t_str + \
-            "AND farm_crops.crop_id = crops.id " \
-            "AND farm_crops.farm_id = %s;"
-        cur.execute(a, (policy["farm_id"],))
+        cur.execute(QUERIES["farm_crops"], {"market_symbols": MARKET_SYMBOLS[policy["combined_market_symbol"]],
+                                            "farm_id": policy["farm_id"]})
         farm_crops = [x[0] for x in cur.fetchall()]
 
-        self.v_print("Creating SQL array of farm_crop ID's..")
-        # Creates a string representing an SQL array with all farm_crop_id's that we need to look for specific zones
-        t_str = "ANY(ARRAY["
-        t_str += str(farm_crops).strip("[]") + "])"
+        # Every zone any sheet could use, fetched once and worked out once, then shared by all of the sheets
+        # Each entry is (zone row, zone dictionary for the sheet), see QUERIES["policy_zones"] for the row's columns
+        self.v_print("Fetching zones..")
+        cur.execute(QUERIES["policy_zones"], {"policy_id": policy_id, "farm_crops": farm_crops})
+        zone_table = []
+        for result in cur.fetchall():
+            # Formats Field Name - Zone Name
+            name_key = result[0] + " - " + result[1]
+
+            # Math Stuff #
+            # Actual Yield = Yield_goal - (yield_goal * loss_percent)
+            actual_yield = result[3] - (result[3] * (result[5] / 100.0))
+
+            # Actual Production = actual_yield * fsa_acres
+            actual_production = actual_yield * result[4]
+
+            zone_table.append((result, {"Field-Zone": name_key,
+                                        "Acres": result[2],
+                                        "Actual Production": actual_production,
+                                        "Actual Yield": actual_yield}))
 
         # This list is used later on to loop through and do unit-specific calculations
+        # HPP and optional sheets pick their zones out of zone_table by practice, enterprise sheets use all of them
         check_l = []
-
-        # Gets the zones for each sheet (*_units) if they're in usable_units
         if "hpp_units" in usable_units:
-            self.v_print("Generating hpp_units zones..")
-
-            hpp = "SELECT DISTINCT zones.id " \
-                  "FROM insurances, farms, fields, zones " \
-                  "WHERE insurances.id = %s " \
-                  "AND farms.id = insurances.farm_id " \
-                  "AND fields.farm_id = farms.id " \
-                  "AND zones.field_id = fields.id " \
-                  "AND zones.county_id = insurances.county_id " \
-                  "AND zones.irrigated = " + str(policy["hpp_practice"]) + " " \
-                  "AND zones.farm_crop_id = " + t_str + ";"
-            cur.execute(hpp, (policy_id,))
-            hpp_zones = [x[0] for x in cur.fetchall()]
-            check_l.append((hpp_zones, "hpp_units"))
+            check_l.append(([z for z in zone_table if z[0][10] == policy["hpp_practice"]], "hpp_units"))
 
         if "optional_units" in usable_units:
-            self.v_print("Generating optional_units zones..")
-
-            optional = "SELECT DISTINCT zones.id " \
-                       "FROM insurances, farms, fields, zones " \
-                       "WHERE insurances.id = %s " \
-                       "AND farms.id = insurances.farm_id " \
-                       "AND fields.farm_id = farms.id " \
-                       "AND zones.field_id = fields.id " \
-                       "AND zones.county_id = insurances.county_id " \
-                       "AND zones.irrigated = " + str(policy["practice"]) + " " \
-                       "AND zones.farm_crop_id = " + t_str + ";"
-            cur.execute(optional, (policy_id,))
-            optional_zones = [x[0] for x in cur.fetchall()]
-            check_l.append((optional_zones, "optional_units"))
+            check_l.append(([z for z in zone_table if z[0][10] == policy["practice"]], "optional_units"))
 
         elif "enterprise_units" in usable_units:
-            self.v_print("Generating enterprise_units zones..")
-
-            enterprise = "SELECT DISTINCT zones.id " \
-                         "FROM insurances, farms, fields, zones " \
-                         "WHERE insurances.id = %s " \
-                         "AND farms.id = insurances.farm_id " \
-                         "AND fields.farm_id = farms.id " \
-                         "AND zones.field_id = fields.id " \
-                         "AND zones.county_id = insurances.county_id " \
-                         "AND zones.farm_crop_id = " + t_str + ";"
-            cur.execute(enterprise, (policy_id,))
-            enterprise_zones = [x[0] for x in cur.fetchall()]
-            check_l.append((enterprise_zones, "enterprise_units"))
-
-        # General information shells for each legal unit
-        unit_gens = {"hpp_units": ["Total Acres", "Modified APH", "MPCI Yield Guarantee",
-                                   "Covered Bushels", "guarantee/acre", "Loss Percent",
-                                   "Potential Bushel Loss", "Potential Dollar Loss", "Actual Dollar Loss"],
-
-                     "optional_units": ["Total Acres", "APH", "Yield Guarantee",
-                                        "guarantee/acre", "Total Bushel Guarantee",
-                                        "MPCI Bushel Loss per acre", "MPCI Loss"],
-
-                     "enterprise_units": ["Total Acres", "APH", "Yield Guarantee",
-                                          "guarantee/acre", "Total Bushel Guarantee",
-                                          "MPCI Bushel Loss per acre", "MPCI Loss"]}
+            check_l.append((zone_table, "enterprise_units"))
 
         self.v_print("Beginning primary calculations loop..")
+        calculator = UnitCalculator(policy, self.verbose, self.very_verbose)
         # Loops through check_l
-        # Inside check_l there are tuples with pairs of (list of zone ids), (string name for the unit)
+        # Inside check_l there are tuples with pairs of (list of zone_table entries), (string name for the unit)
         for page in check_l:
 
-            # SQL query to get legal names of zones using the list of zone ID's we have in check_l
-            a = "SELECT (zones.section, zones.township, zones.range), array_to_string(array_agg(zones.id), ',') " \
-                "FROM zones " \
-                "WHERE zones.id = ANY(ARRAY[" + str(page[0]) + "]) " \
-                "GROUP BY (zones.section, zones.township, zones.range);"
-            cur.execute(a)
-            legals = cur.fetchall()
-
-            # Generates the units (legal definitions) for this sheet #
+            # Groups this sheet's zones by legal description (section, township, range), zones stay in id order
+            legals = {}
+            for zone in page[0]:
+                legals.setdefault(zone[0][11:14], []).append(zone)
 
+            # Every unit only needs its own zones, units are worked out in legal order
             units = {}
-            # Looping through all results of the zones query
-            for u in legals:
-                # Running totals used for "gen" information
-                total_acres = 0.0
-                actual_production_total = 0
-
-                # Turns the string of (Int, North/South, East/West) into a proper legal name
-                # Strips off the ()'s and splits by commas
-                legal_name = u[0].strip("()").split(",")
-                name = "Unit - " + str(legal_name[0]) + " " + str(legal_name[1]) + " " + str(legal_name[2])
-
-                # Gets the general info for this section from unit_gens, and then sets them all to 0 in a dictionary
-                unit_gen = unit_gens[page[1]]
-                gens = dict(zip(unit_gen, [0]*len(unit_gen)))
-                units[name] = {"gen": gens, "zones": [int(x) for x in u[1].split(",")]}
-
-                new_l = []
-                for k, x in enumerate(units[name]["zones"]):
-                    # Finds and returns zone information
-                    a = "SELECT fields.name, zones.name, zones.fsa_acres, " \
-                        "zones.yield_goal, zones.fsa_acres, zones.loss_percent, zones.aph, zones.id " \
-                        "FROM fields, zones " \
-                        "WHERE zones.id = " + str(x) + " " \
-                        "AND zones.field_id = fields.id;"
-                    cur.execute(a)
-                    result = cur.fetchone()
-
-                    # Formats Field Name - Zone Name
-                    name_key = result[0] + " - " + result[1]
-
-                    # Math Stuff #
-                    # Actual Yield = Yield_goal - (yield_goal * loss_percent)
-                    actual_yield = result[3] - (result[3] * (result[5] / 100.0))
-
-                    # Actual Production = actual_yield * fsa_acres
-                    actual_production = actual_yield * result[4]
-
-                    new_l.append({"Field-Zone": name_key,
-                                  "Acres": result[2],
-                                  "Actual Production": actual_production,
-                                  "Actual Yield": actual_yield})
-                    total_acres += float(result[2])
-                    actual_production_total += actual_production
-
-                # Generating general parts of the data set used by all units
-                gen_dict = units[name]["gen"]
-                gen_dict["Total Acres"] = float(total_acres)
-                self.vv_print("Total Acres: " + str(gen_dict["Total Acres"]))
-                self.vv_print("")
-
-                gen_dict["MPCI Yield Guarantee"] = result[6] * (policy["MPCI_coverage"] / 100.0)
-                self.vv_print("MPCI Yield Guarantee: " + str(gen_dict["MPCI Yield Guarantee"]))
-                self.vv_print("^ = zones.aph * (mpci_coverage / 100.0)")
-                self.vv_print("^ = " + str(result[6]) + " * " + "(" + str(policy["MPCI_coverage"]) + " / " + "100.0")
-                self.vv_print("")
-
-                # Query to get the harvest prices and spring prices (in cents)
-                q = "SELECT farm_crops.harvest_price_cents, farm_crops.spring_price_cents " \
-                    "FROM zones,farm_crops " \
-                    "WHERE zones.id = " + str(result[7]) + " " \
-                    "AND farm_crops.id = zones.farm_crop_id;"
-                cur.execute(q)
-                res = cur.fetchone()
-                harvest_price = res[0]
-                spring_price = res[1]
-                production_total = actual_production_total / float(total_acres)
-                self.vv_print("Production Total: " + str(production_total))
-                self.vv_print("^ = actual_production_toal / total_acres")
-                self.vv_print("^ = " + str(actual_production_total) + " / " + str(float(total_acres)))
-                self.vv_print("")
+            for legal_name in sorted(legals):
+                name, unit, unit_result, zone_results, prices = calculator.calculate(page[1], legal_name,
+                                                                                     legals[legal_name])
+                units[name] = unit
+                self.unit_results.append(unit_result)
+                self.zone_results.extend(zone_results)
 
                 # While we're here, we go ahead and set some more policy attributes to show on the policy_info sheet
-                data_set["policy_info"]["Harvest Price"] = "$" + str(harvest_price / 100.0)
-                data_set["policy_info"]["Spring Price"] = "$" + str(spring_price / 100.0)
-
-                # Generating unit-specific data
-                # If we're working with Optional or Enterprise
-                if page[1] != "hpp_units":
-                    self.v_print("Generating enterprise and optional calculations..")
-                    self.v_print("--------------------------------------------------")
-
-                    gen_dict["APH"] = result[6]
-                    if gen_dict["MPCI Yield Guarantee"] > 0:
-                        gen_dict["guarantee/acre"] = (spring_price / 100.0) * gen_dict["MPCI Yield Guarantee"]
-                        _a = "^ = (spring_price / 100.0) * mpci_yield_guarantee"
-                        _b = "^ = (" + str(spring_price) + " / 100.0) * " + str(gen_dict["MPCI Yield Guarantee"])
-                    else:
-                        gen_dict["guarantee/acre"] = 0
-                        _a = "^ = 0"
-                        _b = "^ = 0"
-                    self.vv_print("guarantee/acre = " + str(gen_dict["guarantee/acre"]))
-                    self.vv_print(_a)
-                    self.vv_print(_b)
-                    self.vv_print("")
-
-                    gen_dict["Total Bushel Guarantee"] = gen_dict["MPCI Yield Guarantee"] * total_acres
-                    self.vv_print("Total Bushel Guarantee: " + str(gen_dict["Total Bushel Guarantee"]))
-                    self.vv_print("^ = MPCI Yield Guarantee * Total Acres")
-                    self.vv_print("^ = " + str(gen_dict["MPCI Yield Guarantee"]) + " * " + str(total_acres))
-                    self.vv_print("")
-
-                    # Calculates trigger_yield, which is used in future calculations
-                    if harvest_price < spring_price:
-                        b = float(gen_dict["guarantee/acre"] / float(harvest_price))
-                        _a = "^ = guarantee/acre / harvest_price"
-                        _b = "^ = " + str(gen_dict["guarantee/acre"]) + " / " + str(float(harvest_price))
-                    else:
-                        b = gen_dict["MPCI Yield Guarantee"]
-                        _a = "^ = MPCI Yield Guarantee"
-                        _b = "^ = " + str(gen_dict["MPCI Yield Guarantee"])
-                    trigger_yield = b
-                    self.vv_print("Trigger Yield: " + str(trigger_yield))
-                    self.vv_print(_a)
-                    self.vv_print(_b)
-                    self.vv_print("")
-
-                    if trigger_yield > production_total:
-                        a = trigger_yield - production_total
-                        _a = "^ = trigger_yield - production_total"
-                        _b = "^ = " + str(trigger_yield) + " - " + str(production_total)
-                    else:
-                        a = 0
-                        _a = "^ = 0"
-                        _b = "^ = 0"
-
-                    gen_dict["MPCI Bushel Loss per acre"] = a
-                    self.vv_print("MPCI Bushel Loss per acre: " + str(gen_dict["MPCI Bushel Loss per acre"]))
-                    self.vv_print(_a)
-                    self.vv_print(_b)
-                    self.vv_print("")
-
-                    _a = (harvest_price / 100.0) * gen_dict["MPCI Bushel Loss per acre"] * total_acres
-                    gen_dict["MPCI Loss"] = _a
-                    self.vv_print("MPCI Loss: " + str(gen_dict["MPCI Loss"]))
-                    self.vv_print("^ = (harvest_price / 100.0) * MPCI Bushel Loss per acre * total_acres")
-                    self.vv_print("^ = (" + str(harvest_price / 100.0) + ") * "
-                                  + str(gen_dict["MPCI Bushel Loss per acre"]) + " * " + str(total_acres))
-                    self.vv_print("")
-
-                    # Converting to currency - Doing it after everything because calculations require solid numbers
-                    gen_dict["guarantee/acre"] = self.to_currency(gen_dict["guarantee/acre"])
-                    gen_dict["MPCI Loss"] = self.to_currency(gen_dict["MPCI Loss"])
-
-                    # Rounding - We round after calculations to ensure accuracy in the calculations
-                    gen_dict["MPCI Bushel Loss per acre"] = round(gen_dict["MPCI Bushel Loss per acre"], 2)
-
-                # If we're working with HPP
-                else:
-                    self.v_print("Generating hpp calculations..")
-                    self.v_print("-----------------------------------------")
-
-                    percent_spring_price = (spring_price / 100.0) * (policy["percent_of_spring_price"] / 100.0)
-                    self.v_print("% of sprint price: " + str(percent_spring_price))
-                    self.vv_print("^ = (spring_price / 100.0) * (percent_of_spring_price / 100.0")
-                    self.vv_print("^ = (" + str(spring_price / 100.0) +
-                                  str(policy["percent_of_spring_price"]) + " / 100.0")
-                    self.v_print("")
-
-                    gen_dict["Modified APH"] = result[6] * (policy["hpp_coverage"] / 100.0)
-                    self.v_print("Modified APH: " + str(gen_dict["Modified APH"]))
-                    self.vv_print("^ = zones.aph * (hpp_coverage / 100.0)")
-                    self.vv_print("^ = " + str(result[6]) + " * " + str(policy["hpp_coverage"]) + " / 100.0")
-                    self.v_print("")
-
-                    _a = gen_dict["Modified APH"] - result[6] * (policy["MPCI_coverage"] / 100.0)
-                    gen_dict["Covered Bushels"] = _a
-                    self.v_print("Covered Bushels: " + str(_a))
-                    self.vv_print("^ = Modified APH - zones.aph * (mpci_coverage / 100.0)")
-                    self.vv_print("^ = " + str(gen_dict["Modified APH"]) + " - " + str(result[6]))
-
-                    gen_dict["guarantee/acre"] = percent_spring_price * gen_dict["Covered Bushels"]
-                    gen_dict["Loss Percent"] = result[5]
-
-                    # Calculates potential_bushel_loss
-                    total_bushel_loss = gen_dict["Modified APH"] * gen_dict["Loss Percent"]
-                    if gen_dict["Covered Bushels"] > total_bushel_loss:
-                        _a = total_bushel_loss
-                    else:
-                        _a = gen_dict["Covered Bushels"]
-                    gen_dict["Potential Bushel Loss"] = _a
-
-                    # Uses "_a" as a temporary variable to save space and abide by PEP8 line-length standards
-                    _a = percent_spring_price * gen_dict["Potential Bushel Loss"] * gen_dict["Total Acres"]
-                    gen_dict["Potential Dollar Loss"] = _a
-
-                    # Calculates actual_$_loss
-                    if production_total > gen_dict["Modified APH"]:
-                        _a = 0
-                    elif production_total > gen_dict["Modified APH"] - gen_dict["Potential Bushel Loss"]:
-                        if gen_dict["Modified APH"] - production_total < gen_dict["Potential Bushel Loss"]:
-                            _a = percent_spring_price * (gen_dict["Modified APH"] - production_total) * total_acres
-                        else:
-                            _a = percent_spring_price * gen_dict["Potential Bushel Loss"] * total_acres
-                    else:
-                        _a = gen_dict["Potential Dollar Loss"]
-                    gen_dict["Actual Dollar Loss"] = _a
-
-                    # Converting to currency - Doing it after everything because calculations require solid numbers
-                    gen_dict["guarantee/acre"] = self.to_currency(gen_dict["guarantee/acre"])
-                    gen_dict["Potential Dollar Loss"] = self.to_currency(gen_dict["Potential Dollar Loss"])
-                    gen_dict["Actual Dollar Loss"] = self.to_currency(gen_dict["Actual Dollar Loss"])
-
-                # Adds the list of zones for this unit
-                units[name]["zones"] = new_l
-
-                self.v_print("Finished calculations for " + page[1] + "..")
+                data_set["policy_info"]["Harvest Price"] = "$" + str(prices[0] / 100.0)
+                data_set["policy_info"]["Spring Price"] = "$" + str(prices[1] / 100.0)
 
             # Adds the units for this sheet to the final data_set
             data_set[page[1]]["units"] = units
 
+        if self.save_results:
+            self.v_print("Saving unit results..")
+            self.store_results(conn, cur)
+
         self.v_print("Putting data into dictionary attribute..")
         # Finally sets self.dictionary, which is what we use in the Create class
         self.dictionary = data_set
 
+    # Replaces this policy's rows in unit_results/zone_results with the ones just calculated, in one transaction
+    # The inputs hash stored alongside is the one taken before the inputs were read, so refresh_results can tell
+    # when they go stale
+    def store_results(self, conn, cur):
+        from psycopg2.extras import Json, execute_values
+
+        cur.execute(RESULTS_SCHEMA)
+
+        rows = [(self.policy_id, sheet, legal, gen["Total Acres"], gen.get("Total Bushel Guarantee"),
+                 gen.get("MPCI Loss"), gen.get("Potential Dollar Loss"), gen.get("Actual Dollar Loss"), Json(gen))
+                for sheet, legal, gen in self.unit_results]
+        execute_values(cur, "INSERT INTO unit_results (insurance_id, sheet, legal, total_acres, "
+                            "total_bushel_guarantee, mpci_loss, potential_dollar_loss, actual_dollar_loss, gen) "
+                            "VALUES %s "
+                            "ON CONFLICT (insurance_id, sheet, legal) DO UPDATE SET "
+                            "total_acres = EXCLUDED.total_acres, "
+                            "total_bushel_guarantee = EXCLUDED.total_bushel_guarantee, "
+                            "mpci_loss = EXCLUDED.mpci_loss, "
+                            "potential_dollar_loss = EXCLUDED.potential_dollar_loss, "
+                            "actual_dollar_loss = EXCLUDED.actual_dollar_loss, "
+                            "gen = EXCLUDED.gen, "
+                            "refreshed_at = now();", rows)
+
+        rows = [(self.policy_id,) + x for x in self.zone_results]
+        execute_values(cur, "INSERT INTO zone_results (insurance_id, sheet, zone_id, legal, field_zone, acres, "
+                            "actual_production, actual_yield) "
+                            "VALUES %s "
+                            "ON CONFLICT (insurance_id, sheet, zone_id) DO UPDATE SET "
+                            "legal = EXCLUDED.legal, "
+                            "field_zone = EXCLUDED.field_zone, "
+                            "acres = EXCLUDED.acres, "
+                            "actual_production = EXCLUDED.actual_production, "
+                            "actual_yield = EXCLUDED.actual_yield, "
+                            "refreshed_at = now();", rows)
+
+        # now() is fixed for the transaction, so anything older is a unit or zone this policy no longer has
+        cur.execute("DELETE FROM unit_results WHERE insurance_id = %s AND refreshed_at < now();", (self.policy_id,))
+        cur.execute("DELETE FROM zone_results WHERE insurance_id = %s AND refreshed_at < now();", (self.policy_id,))
+
+        cur.execute("INSERT INTO results_refreshes (insurance_id, inputs_hash) VALUES (%s, %s) "
+                    "ON CONFLICT (insurance_id) DO UPDATE SET "
+                    "inputs_hash = EXCLUDED.inputs_hash, "
+                    "refreshed_at = now();", (self.policy_id, self.inputs_hash))
+        conn.commit()
+
     # Used for printing status messages if self.verbose is enabled
     def v_print(self, message):
         if self.verbose:
@@ -800,46 +1316,785 @@ class Generate():
         quit()
 
 
-# Intro function
-def main():
-    doing_connections = True
-    verbose = False
-    very_verbose = False
-
-    # Sample data set
-    dic = {"policy_info":
-          {"Crop": "Corn",
-           "County": "Adair, IA",
-           "Units": "optional",
-           "MPCI Coverage": "60%",
-           "Practice": "non_irrigated"},
-
-           "enterprise_units":
-           {"gen": {"Total": 493, "Total2": 86700, "Total3": 19720},
-            "units": {"unit1": {"gen": {"Total Acres": 10, "total2": 70, "total3": 32},
-                                "zones": [{"Field-Zone": "zone1",
-                                           "Acres": 200,
-                                           "Actual Production": 275000,
-                                           "Actual Yield": 550}]},
-                      "unit2": {"gen": {"Total Acres": 20, "total2": 50, "total3": 75},
-                                "zones": [{"Field-Zone": "zone1",
-                                           "Acres": 200,
-                                           "Actual Production": 275000,
-                                           "Actual Yield": 550}]}}},
-           "hpp_units":
-           {"units": {"unit1": {"gen": {"total acre": 720, "modified APH": 550},
-                                "zones": [{"Field-Zone": "zone1",
-                                           "Acres": 200,
-                                           "Actual Production": 275000,
-                                           "Actual Yield": 550}]}}}}
-
-    # Generate a data set to use
-    if doing_connections:
-        Create("test_file2", Generate(verbose, very_verbose).dictionary, verbose)
-
-    # Use the pre-created data set
+# Tables Generate reads, with only their primary keys, used to bootstrap a local database for the index advisor
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS counties (
+    id integer PRIMARY KEY,
+    county_name text,
+    state text);
+CREATE TABLE IF NOT EXISTS crops (
+    id integer PRIMARY KEY,
+    market_symbol text);
+CREATE TABLE IF NOT EXISTS farms (
+    id integer PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS farm_crops (
+    id integer PRIMARY KEY,
+    farm_id integer,
+    crop_id integer,
+    harvest_price_cents integer,
+    spring_price_cents integer);
+CREATE TABLE IF NOT EXISTS fields (
+    id integer PRIMARY KEY,
+    farm_id integer,
+    name text);
+CREATE TABLE IF NOT EXISTS zones (
+    id integer PRIMARY KEY,
+    field_id integer,
+    county_id integer,
+    farm_crop_id integer,
+    irrigated boolean,
+    section integer,
+    township text,
+    "range" text,
+    name text,
+    fsa_acres double precision,
+    yield_goal double precision,
+    loss_percent double precision,
+    aph double precision);
+CREATE TABLE IF NOT EXISTS insurances (
+    id integer PRIMARY KEY,
+    farm_id integer,
+    farm_crop_id integer,
+    units text,
+    combined_market_symbol text,
+    hpp_coverage integer,
+    county_id integer,
+    practice text,
+    hpp_practice text,
+    mpci_coverage integer,
+    percent_of_spring_price double precision);
+"""
+
+# Synthetic data for SCHEMA: one policy per farm, 3 farm_crops, 10 fields and 50 zones per farm
+SEED = """
+INSERT INTO counties (id, county_name, state)
+    SELECT g, 'County ' || g, 'NE' FROM generate_series(1, 100) g;
+INSERT INTO crops (id, market_symbol)
+    SELECT row_number() OVER (), s FROM unnest(%(symbols)s::text[]) s;
+INSERT INTO farms (id)
+    SELECT g FROM generate_series(1, %(farms)s) g;
+INSERT INTO farm_crops (id, farm_id, crop_id, harvest_price_cents, spring_price_cents)
+    SELECT (f - 1) * 3 + c, f, mod(f * 7 + c, %(crops)s) + 1, 380 + mod(f, 60), 420 + mod(f, 50)
+    FROM generate_series(1, %(farms)s) f, generate_series(1, 3) c;
+INSERT INTO fields (id, farm_id, name)
+    SELECT (f - 1) * 10 + k, f, 'Field ' || k
+    FROM generate_series(1, %(farms)s) f, generate_series(1, 10) k;
+INSERT INTO zones (id, field_id, county_id, farm_crop_id, irrigated, section, township, "range",
+                   name, fsa_acres, yield_goal, loss_percent, aph)
+    SELECT (fields.id - 1) * 5 + z, fields.id, mod(fields.farm_id, 100) + 1, (fields.farm_id - 1) * 3 + mod(z, 3) + 1,
+           mod(z, 2) = 0, mod(fields.id, 36) + 1, (10 + mod(fields.farm_id, 5)) || 'N', (20 + mod(fields.id, 9)) || 'W',
+           'Zone ' || z, 20 + mod(fields.id * z, 100), 180 + mod(fields.id, 40), mod(fields.id * z, 30), 192
+    FROM fields, generate_series(1, 5) z;
+INSERT INTO insurances (id, farm_id, farm_crop_id, units, combined_market_symbol, hpp_coverage, county_id,
+                        practice, hpp_practice, mpci_coverage, percent_of_spring_price)
+    SELECT f, f, (f - 1) * 3 + 1, CASE WHEN mod(f, 2) = 0 THEN 'optional' ELSE 'enterprise' END,
+           'corn', CASE WHEN mod(f, 3) = 0 THEN 120 END, mod(f, 100) + 1,
+           'irrigated', 'irrigated', 80, 100.0
+    FROM generate_series(1, %(farms)s) f;
+ANALYZE;
+"""
+
+# Secondary indexes the queries in QUERIES need, as (name, table, columns, queries it serves)
+# Primary keys already cover the lookups by id (policy, county, the farm_crops join of policy_zones)
+# Zones are split by irrigation and grouped by legal description in Generate, so neither gets an index
+INDEXES = [("zones_county_crop_field_idx", "zones", ["county_id", "farm_crop_id", "field_id"],
+            ["policy_zones", "inputs_hash"]),
+           ("zones_field_id_idx", "zones", ["field_id"], ["policy_zones", "inputs_hash"]),
+           ("fields_farm_id_idx", "fields", ["farm_id"], ["policy_zones", "inputs_hash"]),
+           ("farm_crops_farm_crop_idx", "farm_crops", ["farm_id", "crop_id"], ["farm_crops", "inputs_hash"]),
+           ("crops_market_symbol_idx", "crops", ["market_symbol"], ["farm_crops"])]
+
+
+# Runs every query in QUERIES through EXPLAIN (ANALYZE, BUFFERS), flags sequential scans,
+# and writes or applies the INDEXES migration
+class IndexAdvisor():
+    def __init__(self, dsn, policy_id, verbose):
+        import psycopg2
+
+        self.verbose = verbose
+        self.policy_id = str(policy_id)
+
+        try:
+            self.conn = psycopg2.connect(dsn)
+            self.conn.autocommit = True
+            self.cur = self.conn.cursor()
+        except psycopg2.OperationalError as e:
+            Generate.return_error("Something went wrong when trying to connect to the database.", e)
+
+    # Creates SCHEMA and fills it with SEED for the given number of farms, refusing to touch a database with policies
+    # The check runs before any DDL, so pointing --seed at a real database doesn't create tables in it either
+    def seed(self, farms):
+        self.cur.execute("SELECT to_regclass('insurances') IS NOT NULL;")
+        if self.cur.fetchone()[0]:
+            self.cur.execute("SELECT EXISTS (SELECT 1 FROM insurances);")
+            if self.cur.fetchone()[0]:
+                Generate.return_error("Refusing to seed a database that already has policies.",
+                                      "insurances is not empty")
+
+        self.v_print("Bootstrapping schema..")
+        self.cur.execute(SCHEMA)
+
+        symbols = sorted(set(s for v in MARKET_SYMBOLS.values() for s in v))
+        self.v_print("Seeding " + str(farms) + " farms..")
+        self.cur.execute(SEED, {"symbols": symbols, "farms": farms, "crops": len(symbols)})
+
+    # Works out real parameters for every query from the policy, the same way Generate does
+    def sample_params(self):
+        cur = self.cur
+        params = {"policy": {"policy_id": self.policy_id}}
+
+        cur.execute(QUERIES["policy"], params["policy"])
+        row = cur.fetchone()
+        if row is None:
+            Generate.return_error("Can't build sample query parameters.", "no policy with id " + self.policy_id)
+        policy = dict(zip(POLICY_HEADERS, row))
+        params["county"] = {"county_id": policy["county_id"]}
+        params["inputs_hash"] = params["policy"]
+
+        params["farm_crops"] = {"market_symbols": MARKET_SYMBOLS[policy["combined_market_symbol"]],
+                                "farm_id": policy["farm_id"]}
+        cur.execute(QUERIES["farm_crops"], params["farm_crops"])
+        farm_crops = [x[0] for x in cur.fetchall()]
+
+        params["policy_zones"] = {"policy_id": self.policy_id, "farm_crops": farm_crops}
+        return params
+
+    # Returns (execution ms, buffers hit + read, [(relation, rows)] of sequential scans) for one query
+    def explain(self, name, params):
+        self.cur.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + QUERIES[name], params)
+        result = self.cur.fetchone()[0]
+        # Older psycopg2 versions hand back the json as a string
+        if not isinstance(result, list):
+            result = json.loads(result)
+        plan = result[0]
+
+        seq_scans = []
+        stack = [plan["Plan"]]
+        while stack:
+            node = stack.pop()
+            if node["Node Type"] == "Seq Scan":
+                seq_scans.append((node["Relation Name"], node["Actual Rows"] * node["Actual Loops"]))
+            stack.extend(node.get("Plans", []))
+
+        buffers = plan["Plan"].get("Shared Hit Blocks", 0) + plan["Plan"].get("Shared Read Blocks", 0)
+        return plan["Execution Time"], buffers, seq_scans
+
+    # Explains every query, keeping the best of repeat runs so caching doesn't skew before/after
+    def report(self, params, repeat):
+        results = {}
+        for name in sorted(QUERIES):
+            runs = [self.explain(name, params[name]) for _ in range(repeat)]
+            results[name] = min(runs)
+        return results
+
+    # SQL for the INDEXES that don't exist yet
+    def migration(self):
+        self.cur.execute("SELECT indexname FROM pg_indexes WHERE schemaname = current_schema();")
+        existing = set(x[0] for x in self.cur.fetchall())
+
+        lines = []
+        for name, table, columns, _ in INDEXES:
+            if name not in existing:
+                lines.append("CREATE INDEX IF NOT EXISTS " + name + " ON " + table + " (" + ", ".join(columns) + ");")
+        return lines
+
+    def apply(self, lines):
+        for line in lines:
+            self.v_print(line)
+            self.cur.execute(line)
+        self.cur.execute("ANALYZE;")
+
+    # Used for printing status messages if self.verbose is enabled
+    def v_print(self, message):
+        if self.verbose:
+            print message
+
+
+# Prints one EXPLAIN report, with the before timings alongside when there are some
+def print_index_report(results, before=None):
+    if before is None:
+        print "%-20s %10s %8s  %s" % ("query", "ms", "buffers", "sequential scans")
     else:
-        Create("test_file", dic, verbose)
+        print "%-20s %10s %10s %8s  %s" % ("query", "before ms", "after ms", "buffers", "sequential scans")
+
+    for name in sorted(results):
+        ms, buffers, seq_scans = results[name]
+        scans = ", ".join("%s (%d rows)" % s for s in seq_scans) or "-"
+        if before is None:
+            print "%-20s %10.3f %8d  %s" % (name, ms, buffers, scans)
+        else:
+            print "%-20s %10.3f %10.3f %8d  %s" % (name, before[name][0], ms, buffers, scans)
+
+
+# "results" subcommand: brings unit_results up to date without writing any spreadsheets
+def cmd_results(args):
+    import_for("results")
+    refreshed = refresh_results(args.dsn, args.policy, args.force, args.verbose, args.very_verbose)
+    print "Refreshed " + str(len(refreshed)) + " policies."
+    for policy_id in refreshed:
+        print "  " + str(policy_id)
+
+
+# "indexes" subcommand: EXPLAINs the project's queries and writes or applies the index migration
+def cmd_indexes(args):
+    import_for("indexes")
+    advisor = IndexAdvisor(args.dsn, args.policy, args.verbose)
+
+    if args.seed:
+        advisor.seed(args.seed)
+
+    params = advisor.sample_params()
+    before = advisor.report(params, args.repeat)
+    print_index_report(before)
+
+    lines = advisor.migration()
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write("\n".join(lines) + "\n")
+    if not lines:
+        print
+        print "All recommended indexes exist."
+        return
+    if not args.apply:
+        print
+        print "\n".join(lines)
+        return
+
+    print
+    advisor.apply(lines)
+    print_index_report(advisor.report(params, args.repeat), before)
+
+
+# Dict-like view of one sheet's units in a SpillStore, each unit is read from disk only when it's asked for
+class StoredUnits():
+    def __init__(self, store, name, sheet, unit_names):
+        self.store = store
+        self.name = name
+        self.sheet = sheet
+        self.unit_names = unit_names
+
+    def keys(self):
+        return list(self.unit_names)
+
+    def __iter__(self):
+        return iter(self.unit_names)
+
+    def __len__(self):
+        return len(self.unit_names)
+
+    def __contains__(self, unit_name):
+        return unit_name in self.unit_names
+
+    def __getitem__(self, unit_name):
+        return self.store.load_unit(self.name, self.sheet, unit_name)
+
+
+# On-disk staging area for batch runs, backed by a local SQLite file
+# Data sets are appended one policy at a time (one row per unit) and read back lazily, so generating and
+# rendering can run as separate stages, and a batch only ever holds one policy in memory
+class SpillStore():
+    def __init__(self, path):
+        import sqlite3
+
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.text_factory = str
+
+        # A policy's row is written last in the same transaction as its sheets and units,
+        # so a policy that exists in "policies" is always complete
+        # fingerprint identifies what the data set was built from (the policy's inputs hash, or the JSON file's md5)
+        self.conn.executescript("CREATE TABLE IF NOT EXISTS policies ("
+                                "  name TEXT PRIMARY KEY,"
+                                "  policy_info TEXT NOT NULL,"
+                                "  rendered INTEGER NOT NULL DEFAULT 0,"
+                                "  fingerprint TEXT);"
+                                "CREATE TABLE IF NOT EXISTS sheets ("
+                                "  name TEXT NOT NULL,"
+                                "  sheet TEXT NOT NULL,"
+                                "  extra TEXT NOT NULL,"
+                                "  PRIMARY KEY (name, sheet));"
+                                "CREATE TABLE IF NOT EXISTS units ("
+                                "  name TEXT NOT NULL,"
+                                "  sheet TEXT NOT NULL,"
+                                "  unit TEXT NOT NULL,"
+                                "  gen TEXT NOT NULL,"
+                                "  zones TEXT NOT NULL,"
+                                "  PRIMARY KEY (name, sheet, unit));")
+
+        # Stage files from before fingerprints were kept, their policies count as stale
+        if "fingerprint" not in [x[1] for x in self.conn.execute("PRAGMA table_info(policies);")]:
+            with self.conn:
+                self.conn.execute("ALTER TABLE policies ADD COLUMN fingerprint TEXT;")
+
+    # Stages a whole data set under name, replacing anything previously staged under it
+    def add_policy(self, name, data, fingerprint=None):
+        with self.conn:
+            self.conn.execute("DELETE FROM policies WHERE name = ?;", (name,))
+            self.conn.execute("DELETE FROM sheets WHERE name = ?;", (name,))
+            self.conn.execute("DELETE FROM units WHERE name = ?;", (name,))
+
+            for sheet, sheet_data in data.iteritems():
+                if sheet == "policy_info":
+                    continue
+
+                # Anything on the sheet besides its units (the enterprise "gen" block, for example)
+                extra = dict((k, v) for k, v in sheet_data.iteritems() if k != "units")
+                self.conn.execute("INSERT INTO sheets VALUES (?, ?, ?);", (name, sheet, json.dumps(extra)))
+
+                for unit_name, unit in sheet_data["units"].iteritems():
+                    self.add_unit(name, sheet, unit_name, unit)
+
+            self.conn.execute("INSERT INTO policies (name, policy_info, fingerprint) VALUES (?, ?, ?);",
+                              (name, json.dumps(data["policy_info"]), fingerprint))
+
+    # Appends a single unit, only visible once add_policy commits
+    def add_unit(self, name, sheet, unit_name, unit):
+        self.conn.execute("INSERT INTO units VALUES (?, ?, ?, ?, ?);",
+                          (name, sheet, unit_name, json.dumps(unit["gen"]), json.dumps(unit["zones"])))
+
+    # True if name has been completely staged
+    def has_policy(self, name):
+        cur = self.conn.execute("SELECT 1 FROM policies WHERE name = ?;", (name,))
+        return cur.fetchone() is not None
+
+    # Fingerprint name was staged with, None if it isn't staged or was staged without one
+    def fingerprint(self, name):
+        cur = self.conn.execute("SELECT fingerprint FROM policies WHERE name = ?;", (name,))
+        row = cur.fetchone()
+        return row[0] if row else None
+
+    # Names of every staged policy, optionally only the ones that still need rendering
+    def policy_names(self, pending=False):
+        q = "SELECT name FROM policies"
+        if pending:
+            q += " WHERE rendered = 0"
+        return [x[0] for x in self.conn.execute(q + " ORDER BY name;")]
+
+    # Returns a data set for Create whose units are loaded from disk as they're written out
+    def load(self, name):
+        cur = self.conn.execute("SELECT policy_info FROM policies WHERE name = ?;", (name,))
+        data = {"policy_info": json.loads(cur.fetchone()[0])}
+
+        for sheet, extra in self.conn.execute("SELECT sheet, extra FROM sheets WHERE name = ?;", (name,)).fetchall():
+            cur = self.conn.execute("SELECT unit FROM units WHERE name = ? AND sheet = ?;", (name, sheet))
+            data[sheet] = json.loads(extra)
+            data[sheet]["units"] = StoredUnits(self, name, sheet, [x[0] for x in cur.fetchall()])
+
+        return data
+
+    # Reads one unit back
+    def load_unit(self, name, sheet, unit_name):
+        cur = self.conn.execute("SELECT gen, zones FROM units WHERE name = ? AND sheet = ? AND unit = ?;",
+                                (name, sheet, unit_name))
+        gen, zones = cur.fetchone()
+        return {"gen": json.loads(gen), "zones": json.loads(zones)}
+
+    # Records that name has been rendered, so a resumed batch skips it
+    def mark_rendered(self, name):
+        with self.conn:
+            self.conn.execute("UPDATE policies SET rendered = 1 WHERE name = ?;", (name,))
+
+    def close(self):
+        self.conn.close()
+
+
+# Sample data set, rendered by "render" when no input file is given
+SAMPLE_DATA = {"policy_info":
+               {"Crop": "corn",
+                "County": "Dawson,NE",
+                "Units": "optional",
+                "MPCI Coverage": "80%",
+                "Practice": "irrigated",
+                "HPP Coverage": "120%",
+                "HPP Practice": "irrigated",
+                "Harvest Price": "$4.12",
+                "Spring Price": "$4.62",
+                "Percent of Spring Price": "100.0%"},
+
+               "optional_units":
+               {"units": {"Unit - 18 12N 25W": {"gen": {"Total Acres": 181.74,
+                                                        "APH": 192.0,
+                                                        "Yield Guarantee": 0,
+                                                        "guarantee/acre": "$709.63",
+                                                        "Total Bushel Guarantee": 27915.26,
+                                                        "MPCI Bushel Loss per acre": 0,
+                                                        "MPCI Loss": "$0.00"},
+                                                "zones": [{"Field-Zone": "North - Zone 1",
+                                                           "Acres": 128.1,
+                                                           "Actual Production": 27541.5,
+                                                           "Actual Yield": 215.0},
+                                                          {"Field-Zone": "North - Zone 2",
+                                                           "Acres": 53.64,
+                                                           "Actual Production": 10728.0,
+                                                           "Actual Yield": 200.0}]}}},
+               "hpp_units":
+               {"units": {"Unit - 18 12N 25W": {"gen": {"Total Acres": 181.74,
+                                                        "Modified APH": 230.4,
+                                                        "MPCI Yield Guarantee": 153.6,
+                                                        "Covered Bushels": 76.8,
+                                                        "guarantee/acre": "$354.82",
+                                                        "Loss Percent": 0.0,
+                                                        "Potential Bushel Loss": 0.0,
+                                                        "Potential Dollar Loss": "$0.00",
+                                                        "Actual Dollar Loss": "$0.00"},
+                                                "zones": [{"Field-Zone": "North - Zone 1",
+                                                           "Acres": 128.1,
+                                                           "Actual Production": 27541.5,
+                                                           "Actual Yield": 215.0},
+                                                          {"Field-Zone": "North - Zone 2",
+                                                           "Acres": 53.64,
+                                                           "Actual Production": 10728.0,
+                                                           "Actual Yield": 200.0}]}}}}
+
+
+# Imports the heavy modules a subcommand needs, so the cost is paid in one place (and can be benchmarked)
+# The direct writer backend doesn't need xlsxwriter
+# If timings is a list, (seconds, module) is appended to it for every module imported
+def import_for(command, backend="xlsxwriter", timings=None):
+    modules = COMMAND_IMPORTS[command]
+    if backend != "xlsxwriter":
+        modules = [m for m in modules if m != "xlsxwriter"]
+
+    imported = []
+    for m in modules:
+        start = time.time()
+        imported.append(__import__(m))
+        if timings is not None:
+            timings.append((time.time() - start, m))
+    return imported
+
+
+# Writes a generated data set out as JSON so it can be rendered later without the database
+def dump_data(data, path):
+    with open(path, "w") as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+
+
+# Reads a data set previously written by dump_data
+def load_data(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+# md5 of a file's contents, the fingerprint of a JSON data set staged by batch
+def file_md5(path):
+    import hashlib
+
+    with open(path, "rb") as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+
+# "generate" subcommand: pulls a policy from the database and renders it
+def cmd_generate(args):
+    import_for("generate", args.backend)
+    data = Generate(args.verbose, args.very_verbose, args.policy, args.dsn, args.save_results).dictionary
+
+    if args.dump:
+        dump_data(data, args.dump)
+    if not args.no_render:
+        Create(args.output, data, args.verbose, args.backend)
+
+
+# "render" subcommand: renders a JSON data set (or the built in sample), never touches the database
+def cmd_render(args):
+    import_for("render", args.backend)
+    if args.input:
+        data = load_data(args.input)
+    else:
+        data = SAMPLE_DATA
+    Create(args.output, data, args.verbose, args.backend)
+
+
+# Output names of the data sets a batch builds, policies first and then JSON files, in the order they're built
+def batch_names(args):
+    return ["policy_" + str(policy_id) for policy_id in args.policy] + \
+        [os.path.splitext(os.path.basename(path))[0] for path in args.input]
+
+
+# Rejects batch arguments that would silently do something other than asked
+def check_batch(parser, args):
+    if args.no_render and not args.stage:
+        parser.error("--no-render needs --stage, without it nothing would be kept")
+
+    seen = set()
+    for name in batch_names(args):
+        if name in seen:
+            parser.error("more than one data set would be written as " + name +
+                         ", rename the JSON file or drop the duplicate")
+        seen.add(name)
+
+
+# "batch" subcommand: renders many policies and/or JSON data sets into one directory
+# With --stage, data sets go through a SpillStore first, so generating and rendering can be run (and resumed) separately
+# A resumed run stages a policy or file again if its inputs changed since it was staged
+def cmd_batch(args):
+    if args.policy:
+        import_for("batch", args.backend)
+    elif not args.no_render:
+        import_for("render", args.backend)
+
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    # Generates a policy, along with the inputs hash it was generated from when staging
+    def generate(policy_id):
+        g = Generate(args.verbose, args.very_verbose, policy_id, args.dsn, False, bool(args.stage))
+        return g.dictionary, g.inputs_hash
+
+    # Connection used to check the inputs of policies that are already staged, opened on first use
+    cursors = []
+
+    def inputs_hash(policy_id):
+        if not cursors:
+            import psycopg2
+            try:
+                cursors.append(psycopg2.connect(args.dsn).cursor())
+            except psycopg2.OperationalError as e:
+                Generate.return_error("Something went wrong when trying to connect to the database.", e)
+        return policy_inputs_hash(cursors[0], policy_id)
+
+    # Every data set to build as (output name, function returning (data set, fingerprint it was built from),
+    # function returning the current fingerprint of its source)
+    makers = [(lambda p=policy_id: generate(p), lambda p=policy_id: inputs_hash(p)) for policy_id in args.policy]
+    makers += [(lambda p=path: (load_data(p), file_md5(p)), lambda p=path: file_md5(p)) for path in args.input]
+    jobs = [(name,) + maker for name, maker in zip(batch_names(args), makers)]
+
+    if not args.stage:
+        for name, make, _ in jobs:
+            Create(os.path.join(args.output_dir, name), make()[0], args.verbose, args.backend)
+        return
+
+    store = SpillStore(args.stage)
+    try:
+        # Generation stage, skips anything a previous run already staged from the same inputs
+        # Anything whose inputs changed since is staged again, which also queues it for rendering again
+        for name, make, fingerprint in jobs:
+            if store.has_policy(name):
+                staged = store.fingerprint(name)
+                if staged is not None and staged == fingerprint():
+                    continue
+                if args.verbose:
+                    print name + " changed since it was staged, staging it again.."
+            data, current = make()
+            store.add_policy(name, data, current)
+
+        if args.no_render:
+            return
+
+        # Rendering stage, skips anything a previous run already rendered
+        for name in store.policy_names(pending=True):
+            Create(os.path.join(args.output_dir, name), store.load(name), args.verbose, args.backend)
+            store.mark_rendered(name)
+    finally:
+        store.close()
+
+
+# Runs a command and returns (wall seconds, return code, stdout, stderr)
+def time_process(cmd, cwd):
+    start = time.time()
+    proc = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    return time.time() - start, proc.returncode, out, err
+
+
+# Run by bench in a fresh interpreter: imports main and a subcommand's modules, timing each one
+# Prints [(seconds, module)] as JSON, slowest first
+IMPORT_SNIPPET = "import time; start = time.time(); import main; " \
+                 "timings = [(time.time() - start, 'main')]; main.import_for(%r, timings=timings); " \
+                 "print main.json.dumps(sorted(timings, reverse=True))"
+
+
+# A copy of SAMPLE_DATA with the given number of units (each with the given number of zones) on both unit sheets
+def make_bench_data(units, zones):
+    data = json.loads(json.dumps(SAMPLE_DATA))
+    for sheet in ("optional_units", "hpp_units"):
+        unit = data[sheet]["units"].popitem()[1]
+        zone = unit["zones"][0]
+        for i in range(units):
+            unit_zones = []
+            for z in range(zones):
+                unit_zones.append(dict(zone, **{"Field-Zone": "Field %d - Zone %d" % (i, z), "Acres": 10.0 + z}))
+            data[sheet]["units"]["Unit - %d 12N 25W" % (i + 1)] = {"gen": dict(unit["gen"]), "zones": unit_zones}
+    return data
+
+
+# Renders make_bench_data with one backend and prints "seconds peak_rss_kb", run by bench in a fresh interpreter
+def bench_render(backend, units, zones, reports):
+    import resource
+    import tempfile
+
+    data = make_bench_data(units, zones)
+    import_for("render", backend)
+    path = os.path.join(tempfile.mkdtemp(), "bench")
+
+    start = time.time()
+    for _ in range(reports):
+        Create(path, data, False, backend)
+    elapsed = time.time() - start
+
+    os.remove(path + ".xlsx")
+    os.rmdir(os.path.dirname(path))
+    print elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+# Times UnitCalculator over synthetic units on both unit sheets, returns seconds
+def bench_calculate(units, zones):
+    policy = {"MPCI_coverage": 80, "hpp_coverage": 120, "percent_of_spring_price": 100.0}
+    jobs = []
+    for sheet in ("optional_units", "hpp_units"):
+        for i in range(units):
+            legal_name = (i + 1, "12N", "25W")
+            unit_zones = []
+            for z in range(zones):
+                acres = 10.0 + z
+                result = ("Field %d" % i, "Zone %d" % z, acres, 200.0, acres, 10.0, 192.0, i * zones + z,
+                          412, 462, True) + legal_name
+                unit_zones.append((result, {"Field-Zone": result[0] + " - " + result[1], "Acres": acres,
+                                            "Actual Production": 180.0 * acres, "Actual Yield": 180.0}))
+            jobs.append((sheet, legal_name, unit_zones))
+
+    calculator = UnitCalculator(policy, False, False)
+    start = time.time()
+    for job in jobs:
+        calculator.calculate(*job)
+    return time.time() - start
+
+
+# "bench" subcommand: measures cold start cost of every subcommand in a fresh interpreter
+def cmd_bench(args):
+    here = os.path.dirname(os.path.abspath(__file__))
+    script = os.path.join(here, "main.py")
+
+    print "%-10s %12s %12s  %s" % ("command", "--help (s)", "imports (s)", "notes")
+    for command in sorted(COMMAND_IMPORTS):
+        help_times = []
+        import_times = []
+        notes = ""
+        for _ in range(args.repeat):
+            help_times.append(time_process([sys.executable, script, command, "--help"], here)[0])
+
+            # Time it takes to get from a cold interpreter to the point the subcommand can start working
+            elapsed, code, out, err = time_process([sys.executable, "-c", IMPORT_SNIPPET % command], here)
+            if code != 0:
+                notes = err.strip().splitlines()[-1]
+                break
+            import_times.append(elapsed)
+
+            # Keeps the breakdown of the fastest run
+            if args.importtime and elapsed == min(import_times):
+                timings = json.loads(out)
+                notes = ", ".join("%s %.1fms" % (m, seconds * 1000.0) for seconds, m in timings[:args.top])
+
+        imports = "%12.4f" % min(import_times) if import_times else "%12s" % "-"
+        print "%-10s %12.4f %s  %s" % (command, min(help_times), imports, notes)
+
+    if not args.units:
+        return
+
+    # Rendering throughput and peak memory of each writer backend, in separate interpreters so memory doesn't mix
+    print
+    print "Rendering %d reports of %d units x %d zones per sheet" % (args.reports, args.units, args.zones)
+    print "%-12s %10s %12s %14s" % ("backend", "seconds", "units/s", "peak rss (MB)")
+    for backend in ("xlsxwriter", "direct"):
+        snippet = "import main; main.bench_render(%r, %d, %d, %d)" % (backend, args.units, args.zones, args.reports)
+        elapsed, code, out, err = time_process([sys.executable, "-c", snippet], here)
+        if code != 0:
+            print "%-12s %10s  %s" % (backend, "-", err.strip().splitlines()[-1])
+            continue
+        seconds, peak = out.split()
+        seconds = float(seconds)
+        units = args.units * 2 * args.reports
+        print "%-12s %10.3f %12.1f %14.1f" % (backend, seconds, units / seconds, int(peak) / 1024.0)
+
+    # Unit calculation, once the zones are fetched
+    print
+    print "Calculating %d units x %d zones per sheet" % (args.units, args.calc_zones)
+    print "%-12s %10s %12s" % ("step", "seconds", "units/s")
+    seconds = bench_calculate(args.units, args.calc_zones)
+    print "%-12s %10.3f %12.1f" % ("calculate", seconds, args.units * 2 / seconds)
+
+
+# Builds the command line parser
+def make_parser():
+    parser = argparse.ArgumentParser(description="Creates crop insurance spreadsheets.")
+    sub = parser.add_subparsers(dest="command")
+
+    # Flags shared by the subcommands that print progress
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("-v", "--verbose", action="store_true", help="print status messages")
+    common.add_argument("-vv", "--very-verbose", action="store_true", help="print calculation details")
+
+    # Flags shared by the subcommands that write spreadsheets
+    writer = argparse.ArgumentParser(add_help=False)
+    writer.add_argument("--backend", choices=["xlsxwriter", "direct"], default="xlsxwriter",
+                        help="spreadsheet writer, direct writes the known layout without xlsxwriter")
+
+    p = sub.add_parser("generate", parents=[common, writer], help="build a spreadsheet from the database")
+    p.add_argument("-p", "--policy", default="24", help="insurances.id to generate (default: 24)")
+    p.add_argument("--dsn", default=DEFAULT_DSN, help="psycopg2 connection string")
+    p.add_argument("-o", "--output", default="test_file2", help="output file name, without .xlsx")
+    p.add_argument("--dump", metavar="JSON", help="also write the generated data set to this file")
+    p.add_argument("--no-render", action="store_true", help="skip writing the spreadsheet")
+    p.add_argument("--save-results", action="store_true", help="also store the numbers in unit_results")
+    p.set_defaults(func=cmd_generate)
+
+    p = sub.add_parser("render", parents=[common, writer], help="build a spreadsheet from a JSON data set")
+    p.add_argument("input", nargs="?", help="data set written by generate --dump (default: sample data)")
+    p.add_argument("-o", "--output", default="test_file", help="output file name, without .xlsx")
+    p.set_defaults(func=cmd_render)
+
+    p = sub.add_parser("batch", parents=[common, writer], help="build many spreadsheets")
+    p.add_argument("-p", "--policy", action="append", default=[], help="insurances.id, may be repeated")
+    p.add_argument("-i", "--input", action="append", default=[], help="JSON data set, may be repeated")
+    p.add_argument("--dsn", default=DEFAULT_DSN, help="psycopg2 connection string")
+    p.add_argument("-d", "--output-dir", default=".", help="directory to write spreadsheets to")
+    p.add_argument("--stage", metavar="DB", help="stage data sets in this SQLite file, resuming a previous run")
+    p.add_argument("--no-render", action="store_true", help="with --stage, only generate")
+    p.set_defaults(func=cmd_batch)
+
+    p = sub.add_parser("results", parents=[common], help="refresh the unit_results table")
+    p.add_argument("-p", "--policy", action="append", help="insurances.id, may be repeated (default: every policy)")
+    p.add_argument("--dsn", default=DEFAULT_DSN, help="psycopg2 connection string")
+    p.add_argument("--force", action="store_true", help="recompute even if the inputs haven't changed")
+    p.set_defaults(func=cmd_results)
+
+    p = sub.add_parser("indexes", help="EXPLAIN the project's queries and suggest indexes")
+    p.add_argument("--dsn", default=DEFAULT_DSN, help="psycopg2 connection string")
+    p.add_argument("-p", "--policy", default="24", help="insurances.id used to fill in query parameters")
+    p.add_argument("--seed", type=int, metavar="FARMS", help="create the schema and seed it with synthetic farms first")
+    p.add_argument("--apply", action="store_true", help="create the missing indexes and report after timings")
+    p.add_argument("-o", "--output", metavar="SQL", help="write the migration to this file")
+    p.add_argument("-n", "--repeat", type=int, default=3, help="EXPLAIN runs per query, the best is kept")
+    p.add_argument("-v", "--verbose", action="store_true", help="print status messages")
+    p.set_defaults(func=cmd_indexes)
+
+    p = sub.add_parser("bench", help="measure cold start time of each subcommand")
+    p.add_argument("-n", "--repeat", type=int, default=5, help="runs per subcommand, the best is kept")
+    p.add_argument("--importtime", action="store_true", help="break import cost down by module")
+    p.add_argument("--top", type=int, default=3, help="modules to list with --importtime")
+    p.add_argument("--units", type=int, default=200, help="units per sheet for the render benchmark, 0 skips it")
+    p.add_argument("--zones", type=int, default=5, help="zones per unit for the render benchmark")
+    p.add_argument("--reports", type=int, default=5, help="reports rendered per backend")
+    p.add_argument("--calc-zones", type=int, default=200, help="zones per unit for the calculation benchmark")
+    p.set_defaults(func=cmd_bench)
+
+    return parser
+
+
+# Intro function
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    # Running with no arguments keeps the old behaviour of generating test_file2
+    if not argv:
+        argv = ["generate"]
+
+    parser = make_parser()
+    args = parser.parse_args(argv)
+    if args.command == "batch":
+        check_batch(parser, args)
+    args.func(args)
 
 if __name__ == "__main__":
     main()